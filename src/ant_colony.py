@@ -5,7 +5,7 @@ import numpy as np
 import cv2
 import pandas as pd
 from enum import Enum ,IntEnum
-import random 
+from sim_rng import SimulationRNG, terrain_seed
 
 class AgentState(Enum):
     FORAGING = 0
@@ -30,32 +30,99 @@ class Nest():
         self.centre_position = position
         self.food = 0
         self.grid_spaces = grid_spaces
+        self.nest_id = None
         
     def add_food(self,food):
         self.food+=food
     
+def default_agent_parameters():
+    return {"fov_var":0.6,"perception_range":6,"perception_falloff":0.15,
+            "activation_falloff":0.5,"attractor_weights":{"food":20,"nest":20,"pos_pher":12,"neg_pher":-10,"for_pher":12}}
+    
 class AgentManager():
 
-    def __init__(self,grid):
-        self.agents = []
+    def __init__(self,grid,batch_mode=False,agent_parameters=None,rng=None,perception_mode="rays"):
         self.grid = grid
+        #SimulationRNG for spawning and direction choices, shared with the grid by default
+        self.rng = grid.rng if rng is None else rng
         self.nests = []
+        #In batch mode every agent is stepped at once by batch_agent_behaviour
+        self.batch_mode = batch_mode
+        #How the batch step perceives: "rays" walks every agent's rays, "fields" reads
+        #whole grid directional sums built by pointer doubling, whose cost does not grow
+        #with perception_range. The per agent step always walks its rays.
+        if(perception_mode not in PERCEPTION_MODES):
+            raise ValueError("Unknown perception mode " + str(perception_mode))
+        self.perception_mode = perception_mode
+        if(agent_parameters is None):
+            agent_parameters = default_agent_parameters()
+        #Parameter profiles shared by all agents of a caste, agent_caste indexes into castes.
+        #agent_parameters is caste 0, the profile agents get unless told otherwise.
+        self.agent_parameters = agent_parameters
+        self.castes = [agent_parameters]
+        self.max_capacity = 0.5
+        #Agent state lives in these arrays, agents is a sequence of Agent views into them
+        self.num_agents = 0
+        self.agents = AgentList(self)
+        self.agent_positions = np.zeros((0,2),dtype=np.int32)
+        self.agent_directions = np.zeros(0,dtype=np.int8)
+        self.agent_states = np.zeros(0,dtype=np.int8)
+        self.agent_food = np.zeros(0,dtype=np.float32)
+        self.agent_alive = np.zeros(0,dtype=bool)
+        self.agent_caste = np.zeros(0,dtype=np.uint8)
+        #Number of live agents on each cell, kept in sync by the Agent views and batch step
+        self.occupancy = np.zeros(grid.grid_size,dtype=np.uint16)
+        #Called as listener(agent_manager) after every completed tick, e.g. a TrajectoryRecorder
+        self.tick = 0
+        self.tick_listeners = []
+        #Optional TickProfiler, set by its attach(). Left as None the tick is not instrumented.
+        self.profiler = None
+        
+    def ensure_agent_capacity(self,num_agents):
+        capacity = len(self.agent_directions)
+        if(num_agents<=capacity):
+            return
+        new_capacity = max(num_agents,2*capacity,16)
+        self.agent_positions = np.resize(self.agent_positions,(new_capacity,2))
+        self.agent_directions = np.resize(self.agent_directions,new_capacity)
+        self.agent_states = np.resize(self.agent_states,new_capacity)
+        self.agent_food = np.resize(self.agent_food,new_capacity)
+        self.agent_alive = np.resize(self.agent_alive,new_capacity)
+        self.agent_caste = np.resize(self.agent_caste,new_capacity)
+        
+    def add_caste(self,agent_parameters):
+        #Registers a parameter profile and returns the caste index to spawn agents with
+        if(len(self.castes)>np.iinfo(self.agent_caste.dtype).max):
+            raise ValueError("At most %d castes are supported" % (np.iinfo(self.agent_caste.dtype).max+1))
+        self.castes.append(agent_parameters)
+        return len(self.castes)-1
     
-    def add_agent_at_position(self,position):
+    def add_agent_at_position(self,position,caste=0):
         if(self.grid.check_agent_position_valid(position)):
             if(not self.is_agent_at_position(position)):
-                agent = Agent(len(self.agents),position)
-                self.agents.append(agent)
+                agent_id = self.num_agents
+                self.ensure_agent_capacity(agent_id+1)
+                self.agent_positions[agent_id] = position
+                self.agent_directions[agent_id] = self.rng.agents.integers(6)
+                self.agent_states[agent_id] = AgentState.FORAGING.value
+                self.agent_food[agent_id] = 0
+                self.agent_caste[agent_id] = caste
+                self.agent_alive[agent_id] = True
+                self.occupancy[position[0],position[1]] += 1
+                self.num_agents += 1
                 return True
             else:
                 print("Agent already at position " + str(position))
         else:
             print("Position not valid for agent placement")
         return False
+    
+    def remove_agent(self,agent):
+        agent.is_alive = False
+        
     def is_agent_at_position(self,position):
-        for agent in self.agents:
-            if(agent.position == position):
-                return True
+        if(self.grid.check_position_valid(position)):
+            return self.occupancy[position[0],position[1]]>0
         return False
     
     def is_position_free_for_agent(self,position):
@@ -63,17 +130,26 @@ class AgentManager():
             and not self.is_agent_at_position(position)):
             return True
         return False
+    
+    def are_positions_free_for_agent(self,positions):
+        #Bulk is_position_free_for_agent, returns a bool array with one entry per position
+        positions = np.asarray(positions,dtype=np.int64).reshape(-1,2)
+        xs = positions[:,0]
+        ys = positions[:,1]
+        free = self.grid.check_positions_valid(xs,ys)
+        free[free] = self.occupancy[xs[free],ys[free]]==0
+        return free
 
     def create_nest_around_point(self,position,radius):
         grid_spaces = self.grid.get_circle_positions_around_point(position, radius)
         nest = Nest(position,grid_spaces)
         self.nests.append(nest)
-        for grid_space in grid_spaces:
-            self.grid.grid[grid_space[0],grid_space[1]].type = SpaceType.NEST
-            self.grid.grid[grid_space[0],grid_space[1]].nest = nest
-            self.grid.grid[grid_space[0],grid_space[1]].nest_value = 1
+        xs,ys = np.array(grid_spaces).T
+        self.grid.set_space_types(xs,ys,SpaceType.NEST)
+        self.grid.nest_id[xs,ys] = self.grid.register_nest(nest)
+        self.grid.nest_value[xs,ys] = 1
             
-    def spawn_agents_around_point(self,num_agents,position,radius=None,desired_density=0.4,strict_radius=False):
+    def spawn_agents_around_point(self,num_agents,position,radius=None,desired_density=0.4,strict_radius=False,caste=0):
         if(radius==None):
             desired_spaces = int(num_agents/desired_density)
             proposed_radius= 0 
@@ -83,11 +159,15 @@ class AgentManager():
                     break
                 proposed_radius+=1
                 
-        potential_spawn_points = []
+        #Discs grow ring by ring with the inner rings first, so only the new rings are checked
+        potential_spawn_points = np.zeros((0,2),dtype=np.int64)
+        num_checked = 0
         while(True):
-            potential_spawn_points = [agent_position for agent_position in 
-                        self.grid.get_circle_positions_around_point(position, radius)
-                        if self.is_position_free_for_agent(agent_position)]            
+            circle_positions = self.grid.get_disc_offsets(radius,position[0]%2)+position
+            new_positions = circle_positions[num_checked:]
+            potential_spawn_points = np.concatenate([potential_spawn_points,
+                                                     new_positions[self.are_positions_free_for_agent(new_positions)]])
+            num_checked = len(circle_positions)
             if(len(potential_spawn_points)>=num_agents):
                 break
             else:
@@ -97,20 +177,42 @@ class AgentManager():
                     break
                 radius+=1
         
-        potential_spawn_point_indices = [i for i in range(len(potential_spawn_points))]
-        spawn_point_indices = np.random.choice(potential_spawn_point_indices,num_agents,replace=False)
+        spawn_point_indices = self.rng.agents.choice(len(potential_spawn_points),num_agents,replace=False)
         
         for spawn_point_index in spawn_point_indices:
             #print("spawning at " + str(potential_spawn_points[spawn_point_index]))
-            self.add_agent_at_position(potential_spawn_points[spawn_point_index])
+            self.add_agent_at_position(potential_spawn_points[spawn_point_index].tolist(),caste)
             
     
         
         
     def iterate_system(self):
-        for agent in self.agents:
-            self.agent_behaviour(agent)
+        profiler = self.profiler
+        if(profiler is not None):
+            profiler.start_tick()
+        if(self.batch_mode):
+            self.batch_agent_behaviour()
+        else:
+            for agent in self.agents:
+                if(agent.is_alive):
+                    if(profiler is not None):
+                        profiler.skip()
+                    self.agent_behaviour(agent)
+        if(profiler is not None):
+            profiler.skip()
         self.grid.iterate_grid()
+        self.tick += 1
+        if(profiler is not None):
+            profiler.lap("decay")
+            profiler.end_tick(self.tick)
+        for listener in self.tick_listeners:
+            listener(self)
+            
+    def add_tick_listener(self,listener):
+        self.tick_listeners.append(listener)
+        
+    def remove_tick_listener(self,listener):
+        self.tick_listeners.remove(listener)
             
     def agent_behaviour(self,agent):
         
@@ -132,6 +234,10 @@ class AgentManager():
                 agent.food = 0
                 agent.state = AgentState.FORAGING
       
+        profiler = self.profiler
+        if(profiler is not None):
+            profiler.lap("food")
+            profiler.count("agents_stepped")
             
         forward_dir_int = int(agent.direction)
         #print(forward_dir_int)
@@ -152,17 +258,19 @@ class AgentManager():
         
         grid_positions = [self.grid.raycast_in_direction(agent.position, direction, 
                                                          agent_params["perception_range"]) for direction in direction_modulo]
+        if(profiler is not None):
+            profiler.lap("perception")
+            profiler.count("cells_sampled",sum(len(pos_list) for pos_list in grid_positions))
+            profiler.count("rays_cut_off",sum(0<len(pos_list)<agent_params["perception_range"] for pos_list in grid_positions))
       
-        grid_pos_objs = [[self.grid.grid[x,y] for x,y in pos] for pos in grid_positions]
-        
-        grid_pos_stats = [[np.array([pos.food,pos.positive_pher,pos.negative_pher,pos.forage_pher,pos.nest_value]) for pos in pos_list] for pos_list in grid_pos_objs]
-        grid_pos_falloff = [np.array([exp_falloff(i,agent_params["perception_falloff"]) for i in range(len(pos_list))]) for pos_list in grid_pos_objs]
+        grid_pos_stats = [self.grid.get_position_stats(pos_list) for pos_list in grid_positions]
+        grid_pos_falloff = [np.array([exp_falloff(i,agent_params["perception_falloff"]) for i in range(len(pos_list))]) for pos_list in grid_positions]
         grid_pos_falloff_norm = [falloff/np.sum(falloff) for falloff in grid_pos_falloff]
         
         #print(grid_pos_falloff_norm)
         grid_pos_weights = [np.sum([stats[i]*falloff[i] for i in range(len(stats))],axis=0) for stats,falloff in zip(grid_pos_stats,grid_pos_falloff_norm)]
         
-        is_position_free = [self.is_position_free_for_agent(pos[0]) for pos in grid_positions]
+        is_position_free = list(self.are_positions_free_for_agent([pos[0] for pos in grid_positions]))
         
         attractor_stats = agent_params["attractor_weights"]
         if(agent.state == AgentState.FORAGING):
@@ -171,13 +279,20 @@ class AgentManager():
             attractor_weights = np.array([0,0,attractor_stats["neg_pher"],attractor_stats["for_pher"],attractor_stats["nest"]])
   
         old_position = agent.position
+        if(profiler is not None):
+            profiler.lap("stats")
         
         if(not any(is_position_free)):
             fov_weights = fov_weights/np.sum(fov_weights)
             if(len(direction_modulo)!=0):
-                chosen_direction = np.random.choice(direction_modulo,p=fov_weights)
+                chosen_direction = direction_modulo[sample_weighted(fov_weights,self.rng.uniform())]
+                if(profiler is not None):
+                    profiler.count("random_draws")
             else:
                 chosen_direction = agent.direction
+            if(profiler is not None):
+                profiler.count("blocked_moves")
+                profiler.lap("choice")
         else:          
             computed_direction_weights = np.array([np.sum(attractor_weights*grid_pos_weight) for grid_pos_weight in grid_pos_weights])
             #print(fov_weights,computed_direction_weights,is_position_free)
@@ -191,9 +306,14 @@ class AgentManager():
             
             #print(direction_modulo,final_weights)
             
-            chosen_direction = np.random.choice(direction_modulo,p=final_weights)
+            chosen_direction = direction_modulo[sample_weighted(final_weights,self.rng.uniform())]
+            if(profiler is not None):
+                profiler.count("random_draws")
+                profiler.lap("choice")
             agent.position = self.grid.get_position_in_direction(agent.position, chosen_direction)
         agent.direction = GridDirection(chosen_direction)
+        if(profiler is not None):
+            profiler.lap("movement")
         
         if(np.sum(is_position_free)>2):
             if(agent.state == AgentState.FORAGING):
@@ -202,10 +322,235 @@ class AgentManager():
                 current_grid_space.positive_pher = min(1,0.6+current_grid_space.positive_pher)
         else:
             current_grid_space.negative_pher = min(1,0.5+current_grid_space.negative_pher)
+        if(profiler is not None):
+            profiler.lap("deposit")
 
         #print(old_position, GridDirection(chosen_direction),agent.position)
         
+    def batch_agent_behaviour(self):
+        #Steps every agent at once with the same rules as agent_behaviour. All agents
+        #perceive the grid and agent positions as they were at the start of the tick.
+        #As in agent_behaviour an agent with at least one free neighbour moves into the
+        #cell it picks, even one that was occupied at the start of the tick, and an agent
+        #with none turns but stays put. When several agents pick the same cell the lowest
+        #agent_id takes it while the others stay put facing their chosen direction.
+        alive = np.nonzero(self.agent_alive[:len(self.agents)])[0]
+        if(len(alive)==0):
+            return
+        step = self.batch_collect_food(alive)
+        self.batch_choose_directions(step)
+        movers,target_cells = self.batch_claims(step)
+        target_cells,first_claims = np.unique(target_cells,return_index=True)
+        self.batch_move(step,movers[first_claims],target_cells)
+        self.batch_deposit(step)
+        
+    #The phases of batch_agent_behaviour, kept separate so tiled.py can synchronise
+    #its tiles between them. Each one takes the BatchStep made by batch_collect_food.
+    
+    def batch_collect_food(self,alive):
+        #Pick up food and drop it off at nests
+        grid = self.grid
+        step = BatchStep(self,alive)
+        xs,ys,states,food = step.xs,step.ys,step.states,step.food
+        was_returning = states==AgentState.RETURNING.value
+        picking = (states==AgentState.FORAGING.value) & (grid.food[xs,ys]>0)
+        if(np.any(picking)):
+            self.batch_take_food(food,np.nonzero(picking)[0],xs,ys)
+            full = picking & (food>=self.max_capacity)
+            step.directions[full] = (step.directions[full]+3)%6
+            states[full] = AgentState.RETURNING.value
+        dropping = was_returning & (grid.nest_value[xs,ys]==1)
+        if(np.any(dropping)):
+            nest_food = np.bincount(grid.nest_id[xs[dropping],ys[dropping]],
+                                    weights=food[dropping],minlength=len(grid.nests))
+            for nest_id in np.nonzero(nest_food)[0]:
+                grid.nests[nest_id].add_food(float(nest_food[nest_id]))
+            food[dropping] = 0
+            states[dropping] = AgentState.FORAGING.value
+        if(self.profiler is not None):
+            self.profiler.lap("food")
+            self.profiler.count("agents_stepped",len(alive))
+        return step
+        
+    def batch_choose_directions(self,step,uniforms=None):
+        #uniforms holds one draw per agent in step.alive, by default they come from self.rng
+        grid = self.grid
+        profiler = self.profiler
+        directions,states,castes = step.directions,step.states,step.castes
+        
+        #Candidate directions ordered as in agent_behaviour, forward-3 to forward+2
+        relative_dirs = np.arange(-3,3)
+        candidate_dirs = (directions.astype(np.int64)[:,None]+relative_dirs)%6
+        caste_params = self.caste_parameter_tables()
+        fov_weights = caste_params["fov_weights"][castes]
         
+        if(self.perception_mode=="fields"):
+            grid_pos_weights,neighbor_cells = self.batch_field_perception(step,candidate_dirs,caste_params)
+        else:
+            grid_pos_weights,neighbor_cells = self.batch_ray_perception(step,candidate_dirs,caste_params)
+        is_valid = neighbor_cells!=NO_CELL
+        is_position_free = is_valid & (self.occupancy.reshape(-1)[neighbor_cells]==0)
+        any_free = np.any(is_position_free,axis=1)
+        if(profiler is not None):
+            profiler.lap("stats")
+        
+        attractor_weights = caste_params["attractor_weights"][castes,states]
+        computed_direction_weights = np.sum(grid_pos_weights*attractor_weights[:,None,:],axis=2)
+        final_weights = computed_direction_weights*is_position_free
+        final_weights = np.where(is_valid,final_weights,-np.inf)
+        #The max over valid entries only, agents without a valid neighbour are masked out below
+        row_max = np.max(final_weights,axis=1,keepdims=True)
+        row_max[~np.any(is_valid,axis=1)] = 0
+        final_weights = np.exp(final_weights-row_max)
+        #Agents with no free neighbour choose by field of view alone
+        final_weights[~any_free] = 1
+        final_weights = final_weights*fov_weights*is_valid
+        
+        has_valid = np.any(is_valid,axis=1)
+        if(uniforms is None):
+            uniforms = self.rng.uniforms(np.count_nonzero(has_valid))
+        else:
+            uniforms = uniforms[has_valid]
+        chosen = sample_weighted_rows(final_weights[has_valid],uniforms)
+        movers = np.nonzero(has_valid)[0]
+        directions[movers] = candidate_dirs[movers,chosen]
+        step.neighbor_cells = neighbor_cells
+        step.is_position_free = is_position_free
+        step.any_free = any_free
+        step.movers = movers
+        step.chosen = chosen
+        if(profiler is not None):
+            profiler.lap("choice")
+            profiler.count("random_draws",len(movers))
+        
+    def batch_ray_perception(self,step,candidate_dirs,caste_params):
+        #Falloff weighted mean stats along every candidate direction's ray, and the neighbour
+        #cells. Rays come straight from the grid's ray table, cut short for castes that see
+        #less far than the longest sighted one.
+        grid = self.grid
+        profiler = self.profiler
+        castes = step.castes
+        perception_range = caste_params["perception_range"]
+        rays = grid.get_ray_table(perception_range)[step.cells[:,None],candidate_dirs]
+        agent_ranges = caste_params["perception_ranges"][castes]
+        if(np.any(caste_params["perception_ranges"]!=perception_range)):
+            rays = np.where(np.arange(perception_range)<agent_ranges[:,None,None],rays,NO_CELL)
+        if(profiler is not None):
+            profiler.lap("perception")
+        stat_sums = np.zeros(rays.shape[:2]+(5,))
+        falloff_sums = np.zeros(rays.shape[:2])
+        for i in range(perception_range):
+            ray_alive = rays[...,i]!=NO_CELL
+            falloff = caste_params["falloffs"][castes,i][:,None]*ray_alive
+            stat_sums += grid.gather_cell_stats(np.where(ray_alive,rays[...,i],0))*falloff[...,None]
+            falloff_sums += falloff
+        if(profiler is not None):
+            profiler.count("cells_sampled",np.count_nonzero(rays!=NO_CELL))
+            last_cells = rays[np.arange(len(rays)),:,agent_ranges-1]
+            profiler.count("rays_cut_off",np.count_nonzero((rays[...,0]!=NO_CELL) & (last_cells==NO_CELL)))
+        return stat_sums/np.maximum(falloff_sums,1e-12)[...,None],rays[...,0]
+    
+    def batch_field_perception(self,step,candidate_dirs,caste_params):
+        #batch_ray_perception from the grid's directional ray sums, one pass over the whole
+        #grid per distinct (falloff,range) pair. Equal to the ray walk up to rounding.
+        grid = self.grid
+        profiler = self.profiler
+        castes = step.castes
+        #The stats of every cell plus a column of ones, whose discounted sum is the falloff sum
+        cell_values = np.concatenate([grid.gather_cell_stats(np.arange(grid.grid_size[0]*grid.grid_size[1])),
+                                      np.ones((grid.grid_size[0]*grid.grid_size[1],1),dtype=np.float32)],axis=1)
+        sums = np.zeros((len(castes),6,6))
+        caste_keys = [(params["perception_falloff"],params["perception_range"]) for params in self.castes]
+        for falloff,perception_range in set(caste_keys):
+            in_group = np.isin(castes,[caste for caste,key in enumerate(caste_keys) if key==(falloff,perception_range)])
+            if(not np.any(in_group)):
+                continue
+            sums[in_group] = grid.directional_ray_sums(cell_values,step.cells[in_group],perception_range,
+                                                       exp_falloff(1,falloff))
+        sums = np.take_along_axis(sums,candidate_dirs[...,None],axis=1)
+        if(profiler is not None):
+            profiler.lap("perception")
+            #Ray lengths only touch the agents' cells, their time is left out of the phases
+            agent_ranges = caste_params["perception_ranges"][castes]
+            ray_lengths = np.zeros((len(castes),6),dtype=np.int64)
+            for perception_range in np.unique(agent_ranges).tolist():
+                in_group = agent_ranges==perception_range
+                ray_lengths[in_group] = grid.ray_lengths(step.cells[in_group],perception_range)
+            ray_lengths = np.take_along_axis(ray_lengths,candidate_dirs,axis=1)
+            profiler.count("cells_sampled",np.sum(ray_lengths))
+            profiler.count("rays_cut_off",np.count_nonzero((ray_lengths>0) & (ray_lengths<agent_ranges[:,None])))
+            profiler.skip()
+        neighbor_cells = grid.neighbor_table[step.cells[:,None],candidate_dirs]
+        return sums[...,:5]/np.maximum(sums[...,5],1e-12)[...,None],neighbor_cells
+        
+    def caste_parameter_tables(self):
+        #The castes' parameters as arrays indexed by caste, rebuilt every tick as the
+        #profiles are plain dicts that may be edited between ticks
+        perception_ranges = np.array([params["perception_range"] for params in self.castes])
+        perception_range = int(np.max(perception_ranges))
+        relative_dirs = np.arange(-3,3)
+        attractor_weights = []
+        for params in self.castes:
+            attractor_stats = params["attractor_weights"]
+            attractor_weights.append([[attractor_stats["food"],attractor_stats["pos_pher"],attractor_stats["neg_pher"],0,0],
+                                      [0,0,attractor_stats["neg_pher"],attractor_stats["for_pher"],attractor_stats["nest"]]])
+        return {"perception_ranges":perception_ranges,"perception_range":perception_range,
+                "fov_weights":np.array([normal_values_given_sd(relative_dirs,params["fov_var"]) for params in self.castes]),
+                "falloffs":np.array([[exp_falloff(i,params["perception_falloff"]) for i in range(perception_range)]
+                                     for params in self.castes]),
+                "attractor_weights":np.array(attractor_weights)}
+    
+    def max_perception_range(self):
+        return max(params["perception_range"] for params in self.castes)
+        
+    def batch_claims(self,step):
+        #Indices into step.alive of the agents that move this tick, those with a free neighbour,
+        #and the cells they picked
+        moving = step.any_free[step.movers]
+        movers = step.movers[moving]
+        return movers,step.neighbor_cells[movers,step.chosen[moving]]
+    
+    def batch_move(self,step,movers,target_cells):
+        #Moves the agents that won their claims and writes the step back to the agent arrays
+        alive = step.alive
+        np.subtract.at(self.occupancy.reshape(-1),step.cells[movers],1)
+        np.add.at(self.occupancy.reshape(-1),target_cells,1)
+        self.agent_positions[alive[movers],0],self.agent_positions[alive[movers],1] = self.grid.cell_to_position(target_cells)
+        self.agent_directions[alive] = step.directions
+        self.agent_states[alive] = step.states
+        self.agent_food[alive] = step.food
+        if(self.profiler is not None):
+            self.profiler.lap("movement")
+            #Agents that stayed put, boxed in, facing an occupied cell or losing a contested one
+            self.profiler.count("blocked_moves",len(alive)-len(movers))
+        
+    def batch_deposit(self,step):
+        #Pheromone deposits on the cells the agents started the tick on
+        grid = self.grid
+        xs,ys,states = step.xs,step.ys,step.states
+        many_free = np.sum(step.is_position_free,axis=1)>2
+        forage_deposit = many_free & (states==AgentState.FORAGING.value)
+        positive_deposit = many_free & (states==AgentState.RETURNING.value)
+        grid.deposit_pheromone(grid.forage_pher,xs[forage_deposit],ys[forage_deposit],0.4)
+        grid.deposit_pheromone(grid.positive_pher,xs[positive_deposit],ys[positive_deposit],0.6)
+        grid.deposit_pheromone(grid.negative_pher,xs[~many_free],ys[~many_free],0.5)
+        if(self.profiler is not None):
+            self.profiler.lap("deposit")
+        
+    def batch_take_food(self,food,agent_indices,xs,ys):
+        cells = xs[agent_indices]*self.grid.grid_size[1]+ys[agent_indices]
+        _,first,counts = np.unique(cells,return_index=True,return_counts=True)
+        single = agent_indices[first[counts==1]]
+        cell_food = self.grid.food[xs[single],ys[single]]
+        food_taken = np.minimum(self.max_capacity-food[single],cell_food)
+        food[single] += food_taken
+        self.grid.food[xs[single],ys[single]] = np.maximum(0,cell_food-food_taken)
+        #Agents sharing a cell take food in agent_id order
+        for agent_index in np.sort(agent_indices[np.isin(cells,cells[first[counts>1]])]):
+            x,y = xs[agent_index],ys[agent_index]
+            food_taken = min(self.max_capacity-food[agent_index],self.grid.food[x,y])
+            food[agent_index] += food_taken
+            self.grid.food[x,y] = max(0,self.grid.food[x,y]-food_taken)
         
 def exp_falloff(x,falloff):
     return np.exp(-x*falloff)
@@ -220,30 +565,238 @@ def sigmoid_activation(x,falloff):
 def normal_values_given_sd(x,var):
     return np.exp(-x**2/(2*var))/(np.sqrt(np.pi*2*var) )   
 
+def counter_uniforms(seed,tick,agent_ids):
+    #Uniform [0,1) draws hashed from (seed,tick,agent id) with the splitmix64 finaliser, so
+    #an agent's draw does not depend on which agents are stepped with it or in which process.
+    #seed may also be an array with one seed per agent, e.g. each agent's ensemble replica.
+    with np.errstate(over="ignore"):
+        x = (np.asarray(seed).astype(np.uint64)*np.uint64(0x9e3779b97f4a7c15)+np.uint64(tick)*np.uint64(0xd1b54a32d192ed03)
+             +np.asarray(agent_ids).astype(np.uint64)*np.uint64(0xaef17502108ef2d9))
+        x = (x^(x>>np.uint64(30)))*np.uint64(0xbf58476d1ce4e5b9)
+        x = (x^(x>>np.uint64(27)))*np.uint64(0x94d049bb133111eb)
+        x = x^(x>>np.uint64(31))
+    return (x>>np.uint64(11)).astype(np.float64)*2.0**-53
+
+def sample_weighted_rows(weights,uniforms):
+    #Inverse-CDF sample of one column per row, rows need not be normalised
+    cdf = np.cumsum(weights,axis=1)
+    targets = uniforms*cdf[:,-1]
+    chosen = np.sum(cdf<=targets[:,None],axis=1)
+    last_nonzero = weights.shape[1]-1-np.argmax(weights[:,::-1]>0,axis=1)
+    return np.minimum(chosen,last_nonzero)
+
+def sample_weighted(weights,uniform):
+    #sample_weighted_rows for a single row and uniform, in plain Python as rows are at most six long
+    weights = weights.tolist()
+    cdf = []
+    total = 0.0
+    last_nonzero = 0
+    for i,weight in enumerate(weights):
+        total += weight
+        cdf.append(total)
+        if(weight>0):
+            last_nonzero = i
+    target = uniform*total
+    chosen = 0
+    while(chosen<len(cdf) and cdf[chosen]<=target):
+        chosen += 1
+    return min(chosen,last_nonzero)
+
+class BatchStep():
+    #Working copies of the live agents' state for one batch tick, filled in phase by phase
+    
+    def __init__(self,manager,alive):
+        self.alive = alive
+        self.xs = manager.agent_positions[alive,0]
+        self.ys = manager.agent_positions[alive,1]
+        self.cells = manager.grid.position_to_cell(self.xs,self.ys)
+        self.directions = manager.agent_directions[alive]
+        self.states = manager.agent_states[alive]
+        self.food = manager.agent_food[alive]
+        self.castes = manager.agent_caste[alive]
+
+PERCEPTION_MODES = ["rays","fields"]
+
+class AgentList():
+    #The manager's agents as a sequence, Agent views are made on access so a colony
+    #costs only its array rows
+    __slots__ = ("manager",)
+    
+    def __init__(self,manager):
+        self.manager = manager
+        
+    def __len__(self):
+        return self.manager.num_agents
+    
+    def __getitem__(self,index):
+        if(isinstance(index,slice)):
+            return [Agent(self.manager,agent_id) for agent_id in range(*index.indices(len(self)))]
+        index = int(index)
+        if(index<0):
+            index += len(self)
+        if(index<0 or index>=len(self)):
+            raise IndexError("agent index out of range")
+        return Agent(self.manager,index)
+    
+    def __iter__(self):
+        return (Agent(self.manager,agent_id) for agent_id in range(len(self)))
+
 class Agent():
+    #A view of one row of the AgentManager's agent arrays
+    __slots__ = ("manager","agent_id")
     
-    def __init__(self,agent_id,position):
+    def __init__(self,manager,agent_id):
+        self.manager = manager
         self.agent_id = agent_id
-        self.is_alive = True
-        self.position = position
-        self.max_capacity = 0.5
-        self.food = 0
-        self.state = AgentState.FORAGING
-        self.direction = random.choice(list(GridDirection))
-        self.agent_parameters = {"fov_var":0.6,"perception_range":6,"perception_falloff":0.15,
-                                 "activation_falloff":0.5,"attractor_weights":{"food":20,"nest":20,"pos_pher":12,"neg_pher":-10,"for_pher":12}}
+        
+    def __eq__(self,other):
+        return isinstance(other,Agent) and self.manager is other.manager and self.agent_id==other.agent_id
+    
+    def __hash__(self):
+        return hash((id(self.manager),self.agent_id))
+        
+    @property
+    def caste(self):
+        return int(self.manager.agent_caste[self.agent_id])
+    
+    @caste.setter
+    def caste(self,caste):
+        self.manager.agent_caste[self.agent_id] = caste
+        
+    @property
+    def agent_parameters(self):
+        return self.manager.castes[self.caste]
+    
+    @property
+    def max_capacity(self):
+        return self.manager.max_capacity
+        
+    @property
+    def position(self):
+        position = self.manager.agent_positions[self.agent_id]
+        return [int(position[0]),int(position[1])]
+    
+    @position.setter
+    def position(self,position):
+        if(self.is_alive):
+            old_position = self.manager.agent_positions[self.agent_id]
+            self.manager.occupancy[old_position[0],old_position[1]] -= 1
+            self.manager.occupancy[position[0],position[1]] += 1
+        self.manager.agent_positions[self.agent_id] = position
+        
+    @property
+    def is_alive(self):
+        return bool(self.manager.agent_alive[self.agent_id])
+    
+    @is_alive.setter
+    def is_alive(self,is_alive):
+        if(is_alive!=self.is_alive):
+            position = self.manager.agent_positions[self.agent_id]
+            if(is_alive):
+                self.manager.occupancy[position[0],position[1]] += 1
+            else:
+                self.manager.occupancy[position[0],position[1]] -= 1
+            self.manager.agent_alive[self.agent_id] = is_alive
+        
+    @property
+    def direction(self):
+        return GridDirection(int(self.manager.agent_directions[self.agent_id]))
+    
+    @direction.setter
+    def direction(self,direction):
+        self.manager.agent_directions[self.agent_id] = int(direction)
+        
+    @property
+    def state(self):
+        return AgentState(int(self.manager.agent_states[self.agent_id]))
+    
+    @state.setter
+    def state(self,state):
+        self.manager.agent_states[self.agent_id] = state.value
+        
+    @property
+    def food(self):
+        return float(self.manager.agent_food[self.agent_id])
+    
+    @food.setter
+    def food(self,food):
+        self.manager.agent_food[self.agent_id] = food
     
         
 from perlin_noise import PerlinNoise   
+from terrain import load_noise_field
+from field_storage import (allocate_layer, decay_fixed_point, decode_pheromones, encode_pheromones,
+                           fixed_point_scale)
+
+PHEROMONE_LAYERS = ["positive_pher","negative_pher","forage_pher"]
+#Sentinel used in the flat cell id lookup tables for out of bounds cells and walls
+NO_CELL = -1
+#Whole grid passes that build temporaries work through the rows in chunks of about this many cells
+CHUNK_CELLS = 1<<20
+#Grid arrays that can be handed to Grid(shared_arrays=...) instead of being built,
+#pheromone_ticks is None and left out unless the grid decays lazily
+SHARED_GRID_ARRAYS = ["type","nest_id","nest_value","food","pheromones","pheromone_ticks",
+                      "hex_neighbor_table","neighbor_table"]
     
 class Grid():
     
-    def __init__(self,grid_size,perlin_octaves,wall_threshold):
+    def __init__(self,grid_size,perlin_octaves,wall_threshold,seed=None,terrain_cache_dir=None,noise_field=None,
+                 lazy_decay=False,decay_epsilon=1e-6,shared_arrays=None,rng=None,
+                 pheromone_dtype="float32",storage_dir=None):
         self.grid_size = grid_size
+        #SimulationRNG for nest and food placement, seeded from the terrain seed unless given
+        self.rng = SimulationRNG(seed) if rng is None else rng
         self.agents = []
-        self.perlin_noise = PerlinNoise(octaves=perlin_octaves)
-        self.grid=np.array([[GridSpace(x,y) for y in range(grid_size[1])] for x in range(grid_size[0])])
-        self.update_walls_for_threshold(wall_threshold)
+        #Grids built from this one (tiles, ensembles) pass seed on, the terrain comes from a seed
+        #derived from it, see sim_rng.terrain_seed
+        self.seed = seed
+        self.perlin_noise = PerlinNoise(octaves=perlin_octaves,seed=terrain_seed(seed))
+        #Noise for every cell, generated once (or read from terrain_cache_dir) and re-thresholded on demand.
+        #A precomputed noise_field, e.g. one in shared memory, is used as is and never written to.
+        #With a storage_dir the grid arrays, and the noise field when it is generated here, are
+        #memmaps in that directory (see field_storage) so maps can outgrow physical memory
+        self.storage_dir = storage_dir
+        shape = (grid_size[0],grid_size[1])
+        if(noise_field is None):
+            #Generated (or copied from the cache) row chunk by row chunk
+            out = None if storage_dir is None else self.allocate_array("noise_field",shape,np.float32)
+            noise_field = load_noise_field(grid_size,perlin_octaves,self.perlin_noise.seed,terrain_cache_dir,
+                                           out,self.row_chunks())
+        self.noise_field = noise_field
+        #Structure-of-arrays storage, one typed array per field
+        #shared_arrays, one entry per name in SHARED_GRID_ARRAYS, replaces all of them and the
+        #wall thresholding, e.g. the shared memory views a tiled.TiledSimulation worker gets
+        if(shared_arrays is None):
+            self.type = self.allocate_array("type",shape,np.uint8,SpaceType.EMPTY.value)
+            self.nest_id = self.allocate_array("nest_id",shape,np.int16,-1)
+            self.nest_value = self.allocate_array("nest_value",shape,np.uint8)
+            self.food = self.allocate_array("food",shape,np.float32)
+            #Pheromone layers stacked so they decay in a single pass, ordered as PHEROMONE_LAYERS.
+            #pheromone_dtype is one of field_storage.PHEROMONE_DTYPES, read them through
+            #pheromone_values or get_pheromones, which decode fixed point storage.
+            self.pheromones = self.allocate_array("pheromones",(len(PHEROMONE_LAYERS),)+shape,pheromone_dtype)
+            #The tick each cell was last brought up to, only kept with lazy_decay
+            self.pheromone_ticks = self.allocate_array("pheromone_ticks",shape,np.int64) if lazy_decay else None
+        else:
+            for name in SHARED_GRID_ARRAYS:
+                setattr(self,name,shared_arrays.get(name))
+        self.pheromone_scale = fixed_point_scale(self.pheromones.dtype)
+        #Hex disc offsets per (radius,parity), they only depend on the geometry
+        self.disc_offsets = {}
+        self.positive_pher = self.pheromones[0]
+        self.negative_pher = self.pheromones[1]
+        self.forage_pher = self.pheromones[2]
+        self.pos_pher_decay_rate = 0.05
+        self.forage_pher_decay_rate = 0.2
+        self.neg_pher_decay_rate = 0.3
+        #With lazy_decay iterate_grid only advances decay_tick. pheromones then holds each cell's
+        #value as of pheromone_ticks, decayed in closed form when the cell is read or written and
+        #dropped to zero below decay_epsilon. Whole-grid readers go through get_pheromones().
+        self.lazy_decay = lazy_decay
+        self.decay_epsilon = decay_epsilon
+        self.decay_tick = 0
+        self.nests = []
+        self.grid = GridSpaceArray(self)
         
         self.directions = directions={1:{GridDirection.UPLEFT:[-1,0],GridDirection.UP:[-2,0],
          GridDirection.UPRIGHT:[-1,1],GridDirection.DOWNRIGHT:[1,1],
@@ -251,51 +804,303 @@ class Grid():
          0:{GridDirection.UPLEFT:[-1,-1],GridDirection.UP:[-2,0],
           GridDirection.UPRIGHT:[-1,0],GridDirection.DOWNRIGHT:[1,0],
           GridDirection.DOWN:[2,0],GridDirection.DOWNLEFT:[1,-1]}}
+        #direction_deltas[x%2,direction] gives the same steps as self.directions
+        self.direction_deltas = np.array([[self.directions[parity][direction] for direction in GridDirection]
+                                          for parity in (0,1)],dtype=np.int32)
+        self.direction_steps = tuple(tuple(tuple(delta) for delta in parity_deltas) for parity_deltas in self.direction_deltas.tolist())
+        if(shared_arrays is None):
+            self.build_neighbor_tables()
+            self.update_walls_for_threshold(wall_threshold)
+        else:
+            self.clear_wall_caches()
+    
+    def allocate_array(self,name,shape,dtype,fill=0):
+        return allocate_layer(shape,dtype,fill,self.storage_dir,name)
+    
+    def row_chunks(self,start=0,stop=None):
+        #(start,stop) row ranges of about CHUNK_CELLS cells covering rows start:stop
+        stop = self.grid_size[0] if stop is None else stop
+        rows_per_chunk = max(1,CHUNK_CELLS//self.grid_size[1])
+        return [(row,min(row+rows_per_chunk,stop)) for row in range(start,stop,rows_per_chunk)]
     
     def update_walls_for_threshold(self,wall_threshold):
-        for space in self.grid.flatten():
-            perlin_level = self.perlin_noise([space.x/self.grid_size[0],space.y/self.grid_size[1]])
-            if(perlin_level>wall_threshold):
-                space.type = SpaceType.WALL
-    
-    def find_random_valid_circle(self,radius,max_steps=20):
-        step = 0
-        while(step<max_steps):
-            random_space = self.pick_random_freespace()
-            if(self.check_circle_is_valid([random_space.x,random_space.y],radius)):
-                return random_space
-            step+=1
-        print("Unable to find valid circle")
-        return None
+        for start,stop in self.row_chunks():
+            is_wall = self.noise_field[start:stop]>wall_threshold
+            types = self.type[start:stop]
+            types[is_wall] = SpaceType.WALL.value
+            types[~is_wall & (types==SpaceType.WALL.value)] = SpaceType.EMPTY.value
+        self.update_neighbor_table()
+        
+    def position_to_cell(self,xs,ys):
+        return xs*self.grid_size[1]+ys
+    
+    def cell_to_position(self,cells):
+        return np.divmod(cells,self.grid_size[1])
+    
+    def build_neighbor_tables(self):
+        #hex_neighbor_table[cell,direction] is the flat id of the neighbouring cell,
+        #NO_CELL off the edge of the map. neighbor_table also has NO_CELL for walls.
+        num_columns = self.grid_size[1]
+        num_cells = self.grid_size[0]*num_columns
+        self.hex_neighbor_table = self.allocate_array("hex_neighbor_table",(num_cells,6),np.int32,NO_CELL)
+        self.neighbor_table = self.allocate_array("neighbor_table",(num_cells,6),np.int32,NO_CELL)
+        #One direction of one row chunk at a time, so the temporaries stay a few chunk sized int32 arrays
+        for start,stop in self.row_chunks():
+            xs = np.arange(start,stop,dtype=np.int32)[:,None]
+            ys = np.arange(num_columns,dtype=np.int32)[None,:]
+            for direction in range(6):
+                deltas = self.direction_deltas[xs%2,direction]
+                neighbor_xs = xs+deltas[...,0]
+                neighbor_ys = ys+deltas[...,1]
+                in_bounds = ((neighbor_xs>=0) & (neighbor_xs<self.grid_size[0]) &
+                             (neighbor_ys>=0) & (neighbor_ys<num_columns))
+                self.hex_neighbor_table[start*num_columns:stop*num_columns,direction] = np.where(
+                    in_bounds,self.position_to_cell(neighbor_xs,neighbor_ys),NO_CELL).reshape(-1)
+        self.update_neighbor_table()
+        
+    def update_neighbor_table(self):
+        types = self.type.reshape(-1)
+        num_columns = self.grid_size[1]
+        for start,stop in self.row_chunks():
+            hex_neighbors = self.hex_neighbor_table[start*num_columns:stop*num_columns]
+            blocked = (hex_neighbors==NO_CELL) | (types[hex_neighbors]==SpaceType.WALL.value)
+            self.neighbor_table[start*num_columns:stop*num_columns] = np.where(blocked,NO_CELL,hex_neighbors)
+        self.clear_wall_caches()
+        
+    def patch_neighbor_table(self,cells):
+        #Refresh the neighbor_table entries pointing at cells whose wall state changed
+        cells = np.asarray(cells,dtype=np.int64).reshape(-1)
+        is_wall = self.type.reshape(-1)[cells]==SpaceType.WALL.value
+        for direction in range(6):
+            neighbors = self.hex_neighbor_table[cells,direction]
+            on_map = neighbors!=NO_CELL
+            self.neighbor_table[neighbors[on_map],(direction+3)%6] = np.where(is_wall[on_map],NO_CELL,cells[on_map])
+        self.clear_wall_caches()
+        
+    def clear_wall_caches(self):
+        #Everything derived from the wall layout, rebuilt lazily after a wall edit
+        self.ray_tables = {}
+        self.wall_distance = None
+        self.valid_centres = {}
+        self.free_cells = None
+        self.jump_tables = {}
+        
+    def get_ray_table(self,ray_length):
+        #ray_table[cell,direction,i] is the flat id i+1 steps from cell, NO_CELL from
+        #the first wall or map edge onwards. Built lazily per length and dropped on wall edits.
+        if(ray_length not in self.ray_tables):
+            num_columns = self.grid_size[1]
+            ray_table = self.allocate_array("ray_table_%d" % ray_length,(len(self.neighbor_table),6,ray_length),np.int32)
+            for start,stop in self.row_chunks():
+                current = np.repeat(np.arange(start*num_columns,stop*num_columns,dtype=np.int32)[:,None],6,axis=1)
+                for i in range(ray_length):
+                    on_ray = current!=NO_CELL
+                    current = np.where(on_ray,self.neighbor_table[np.where(on_ray,current,0),np.arange(6)],NO_CELL)
+                    ray_table[start*num_columns:stop*num_columns,:,i] = current
+            self.ray_tables[ray_length] = ray_table
+        return self.ray_tables[ray_length]
+    
+    def get_jump_table(self,level):
+        #jump_table[direction,cell] is the flat id 2**level steps from cell, NO_CELL once a
+        #wall or the map edge cuts the ray as in get_ray_table. Direction major so each
+        #direction is a contiguous index array, and the extra last column is a NO_CELL
+        #sentinel so that NO_CELL entries can be used as indices.
+        if(level not in self.jump_tables):
+            if(level==0):
+                jump_table = np.concatenate([self.neighbor_table,np.full((1,6),NO_CELL,dtype=np.int32)]).T.copy()
+            else:
+                previous = self.get_jump_table(level-1)
+                jump_table = np.stack([np.take(previous[direction],previous[direction]) for direction in range(6)])
+            self.jump_tables[level] = jump_table
+        return self.jump_tables[level]
+    
+    def ray_lengths(self,cells,ray_length):
+        #(len(cells),6) number of cells on each direction's ray from cells, at most ray_length
+        #and cut like get_ray_table. Found by binary lifting over the jump tables, so only the
+        #given cells are visited, log2(ray_length) times.
+        lengths = np.zeros((6,len(cells)),dtype=np.int64)
+        positions = np.repeat(np.asarray(cells)[None,:],6,axis=0)
+        for level in reversed(range(int(ray_length).bit_length())):
+            jump_table = self.get_jump_table(level)
+            for direction in range(6):
+                further = np.take(jump_table[direction],positions[direction])
+                jumping = (further!=NO_CELL) & (lengths[direction]+2**level<=ray_length)
+                positions[direction] = np.where(jumping,further,positions[direction])
+                lengths[direction] += jumping*2**level
+        return lengths.T
+    
+    def directional_ray_sums(self,cell_values,cells,ray_length,discount):
+        #For each of cells and each direction, the sum over the first ray_length cells i of its
+        #ray of discount**i*cell_values[ray cell i], cut off like get_ray_table. cell_values is
+        #indexed by flat id. Built by pointer doubling, blocks[direction] holds the sums over
+        #2**level steps for every cell, so the cost is log2(ray_length) whole grid passes
+        #whatever the range.
+        cell_values = np.asarray(cell_values,dtype=np.float64)
+        cell_values = np.concatenate([cell_values,np.zeros((1,)+cell_values.shape[1:])])
+        blocks = [np.take(cell_values,jumps,axis=0) for jumps in self.get_jump_table(0)]
+        sums = np.zeros((len(cells),6)+cell_values.shape[1:])
+        positions = np.repeat(np.asarray(cells)[None,:],6,axis=0)
+        position_discount = 1.0
+        level = 0
+        remaining = ray_length
+        while(remaining>0):
+            jump_table = self.get_jump_table(level)
+            block_discount = discount**(2**level)
+            for direction in range(6):
+                if(remaining&1):
+                    sums[:,direction] += position_discount*np.take(blocks[direction],positions[direction],axis=0)
+                    positions[direction] = np.take(jump_table[direction],positions[direction])
+                if(remaining>1):
+                    further = np.take(blocks[direction],jump_table[direction],axis=0)
+                    further *= block_discount
+                    blocks[direction] += further
+            if(remaining&1):
+                position_discount *= block_discount
+            remaining >>= 1
+            level += 1
+        return sums
+    
+    def set_space_type(self,position,space_type):
+        was_wall = self.type[position[0],position[1]]==SpaceType.WALL.value
+        self.type[position[0],position[1]] = space_type.value
+        if(was_wall!=(space_type==SpaceType.WALL)):
+            self.patch_neighbor_table(self.position_to_cell(position[0],position[1]))
+    
+    def set_space_types(self,xs,ys,space_type):
+        #Vectorised set_space_type
+        was_wall = self.type[xs,ys]==SpaceType.WALL.value
+        self.type[xs,ys] = space_type.value
+        changed = was_wall!=(space_type==SpaceType.WALL)
+        if(np.any(changed)):
+            self.patch_neighbor_table(self.position_to_cell(np.asarray(xs)[changed],np.asarray(ys)[changed]))
+    
+    def register_nest(self,nest):
+        if(nest.nest_id is None):
+            nest.nest_id = len(self.nests)
+            self.nests.append(nest)
+        return nest.nest_id
+    
+    def get_pheromone_decay_factors(self):
+        decay_rates = [self.pos_pher_decay_rate,self.neg_pher_decay_rate,self.forage_pher_decay_rate]
+        return (1-np.array(decay_rates,dtype=np.float32)).reshape(-1,1,1)
+    
+    def pheromone_values(self,cells):
+        #Current value of every layer for flat cells as float32, shape (len(PHEROMONE_LAYERS),)+cells.shape
+        flat = self.pheromones.reshape(len(PHEROMONE_LAYERS),-1)
+        if(not self.lazy_decay):
+            return decode_pheromones(flat[:,cells])
+        ages = self.decay_tick-self.pheromone_ticks.reshape(-1)[cells]
+        factors = self.get_pheromone_decay_factors().astype(np.float64).reshape((-1,)+(1,)*np.ndim(ages))
+        values = (decode_pheromones(flat[:,cells])*factors**ages).astype(np.float32)
+        values[values<self.decay_epsilon] = 0
+        return values
+    
+    def refresh_pheromone_cells(self,cells):
+        #Brings the stored values of cells up to decay_tick, called before they are written
+        if(not self.lazy_decay):
+            return
+        #Cells already current are left alone, re-rounding fixed point values would drift them
+        cells = np.atleast_1d(cells)
+        cells = cells[self.pheromone_ticks.reshape(-1)[cells]!=self.decay_tick]
+        self.pheromones.reshape(len(PHEROMONE_LAYERS),-1)[:,cells] = encode_pheromones(
+            self.pheromone_values(cells),self.pheromones.dtype,cells,self.decay_tick)
+        self.pheromone_ticks.reshape(-1)[cells] = self.decay_tick
+            
+    def get_pheromones(self):
+        #The (len(PHEROMONE_LAYERS),)+grid_size float32 stack with every cell current. The
+        #pheromones array itself for eager float32 storage, otherwise a decoded copy. Read only:
+        #in lazy mode the cells are decayed into the copy a chunk of rows at a time and the
+        #stored values are left as they are, so observers cannot change the run.
+        if(not self.lazy_decay):
+            return decode_pheromones(self.pheromones)
+        num_columns = self.grid_size[1]
+        pheromones = np.empty((len(PHEROMONE_LAYERS),)+tuple(self.grid_size),dtype=np.float32)
+        for start,stop in self.row_chunks():
+            cells = np.arange(start*num_columns,stop*num_columns)
+            pheromones[:,start:stop] = self.pheromone_values(cells).reshape(len(PHEROMONE_LAYERS),stop-start,num_columns)
+        return pheromones
+    
+    def get_pheromone(self,layer_index,x,y):
+        return float(self.pheromone_values(self.position_to_cell(x,y))[layer_index])
+    
+    def set_pheromone(self,layer_index,x,y,value):
+        cell = self.position_to_cell(x,y)
+        self.refresh_pheromone_cells(cell)
+        self.pheromones[layer_index,x,y] = encode_pheromones(np.array([[value]]),self.pheromones.dtype,
+                                                             np.array([cell]),self.decay_tick)[0,0]
+        
+    def find_random_valid_circle(self,radius):
+        #Uniform over every centre whose disc is clear of walls and the map edge
+        centres = self.get_valid_centres(radius)
+        if(len(centres)==0):
+            print("Unable to find valid circle")
+            return None
+        x,y = self.cell_to_position(centres[self.rng.layout.integers(len(centres))])
+        return self.grid[int(x),int(y)]
         
     def check_circle_is_valid(self,position,radius):
-        grid_spaces = self.get_circle_positions_around_point(position,radius)
-        if (any([not self.check_agent_position_valid(pos) for pos in grid_spaces])):
-            return False
-        return True
+        return self.check_position_valid(position) and self.get_wall_distance()[position[0],position[1]]>radius
+    
+    def get_wall_distance(self):
+        #Hex distance from every cell to the nearest wall or off-map cell, a breadth first
+        #search over hex_neighbor_table out from the walls, with edge cells one step out.
+        #A disc of radius r around a cell is clear exactly when this is above r.
+        if(self.wall_distance is None):
+            distance = np.full(len(self.hex_neighbor_table),-1,dtype=np.int32)
+            frontier = np.nonzero(self.type.reshape(-1)==SpaceType.WALL.value)[0]
+            distance[frontier] = 0
+            edge_cells = np.nonzero(np.any(self.hex_neighbor_table==NO_CELL,axis=1))[0]
+            level = 0
+            while(len(frontier)>0 or level==0):
+                level += 1
+                neighbors = self.hex_neighbor_table[frontier].reshape(-1)
+                if(level==1):
+                    neighbors = np.concatenate([neighbors,edge_cells])
+                neighbors = neighbors[neighbors!=NO_CELL]
+                frontier = np.unique(neighbors[distance[neighbors]<0])
+                distance[frontier] = level
+            self.wall_distance = distance.reshape(self.grid_size[0],self.grid_size[1])
+        return self.wall_distance
+    
+    def get_valid_centres(self,radius):
+        #Flat ids of the cells a disc of radius fits around
+        if(radius not in self.valid_centres):
+            self.valid_centres[radius] = np.nonzero(self.get_wall_distance().reshape(-1)>radius)[0]
+        return self.valid_centres[radius]
+    
+    def get_free_cells(self):
+        #Flat ids of every cell that is not a wall
+        if(self.free_cells is None):
+            self.free_cells = np.nonzero(self.type.reshape(-1)!=SpaceType.WALL.value)[0]
+        return self.free_cells
     
     def add_food_cluster(self,position,radius,food_density):
-        grid_positions = self.get_circle_positions_around_point(position,radius)
-        for pos in grid_positions:
-            random_num = random.random()
-            if(random_num<food_density):
-                self.grid[pos[0],pos[1]].add_food(1)
+        grid_positions = np.array(self.get_circle_positions_around_point(position,radius))
+        placed = grid_positions[self.rng.layout.random(len(grid_positions))<food_density]
+        self.food[placed[:,0],placed[:,1]] += 1
         
     def pick_random_freespace(self):
-        flattened_grid = self.grid.flatten()
-        while(True):       
-            random_space = np.random.choice(flattened_grid)
-            if(random_space.type!=SpaceType.WALL):
-                break
-        return random_space
+        free_cells = self.get_free_cells()
+        x,y = self.cell_to_position(free_cells[self.rng.layout.integers(len(free_cells))])
+        return self.grid[int(x),int(y)]
         
     def check_agent_position_valid(self,position):
         if(self.check_position_valid(position) and 
-           not (self.grid[position[0],position[1]].type == SpaceType.WALL)):
+           not (self.type[position[0],position[1]] == SpaceType.WALL.value)):
             return True
         return False
-        
     def get_circle_positions_around_point(self,position,radius):
+        return (self.get_disc_offsets(radius,position[0]%2)+[position[0],position[1]]).tolist()
+    
+    def get_disc_offsets(self,radius,parity):
+        #Offsets of the disc around a centre on a row of the given parity, in walk_circle order:
+        #the centre, then ring by ring, so a smaller disc is always a prefix of a larger one
+        key = (radius,parity)
+        if(key not in self.disc_offsets):
+            self.disc_offsets[key] = np.array(self.walk_circle([parity,0],radius),dtype=np.int64).reshape(-1,2)-[parity,0]
+        return self.disc_offsets[key]
+    
+    def walk_circle(self,position,radius):
         positions_list = [position]
         upleft_pos=up_pos=upright_pos=downright_pos=down_pos= downleft_pos = position
         for curr_radius in range(radius):
@@ -328,34 +1133,24 @@ class Grid():
         return positions_list
     
     def get_position_type(self,position):
-        return self.grid[position[0],position[1]].type
+        return SpaceType(int(self.type[position[0],position[1]]))
     
     def get_position_neighbors(self,position):
-        x = position[0]
-        y = position[1]
-        if(y%2==0):
-            neighbors = [[x-1,y],[x-2,y],[x-1,y+1],
-                    [x+1,y-1],[x+2,y],[x+1,y]]
-        else:
-            neighbors = [[x-1,y-1],[x-2,y],[x-1,y],
-                    [x+1,y],[x+2,y],[x+1,y-1]] 
-        
-        final_neighbors = []
-        for neighbor in neighbors:
-            neighbor_x = neighbor[0]
-            neighbor_y = neighbor[1]
-            if ((neighbor_x >= 0 and neighbor_x < self.grid_size[0]) and
-                (neighbor_y >= 0 and neighbor_y < self.grid_size[1])):
-                final_neighbors.append(neighbor)
-        return final_neighbors
+        #In-bounds neighbours in GridDirection order, using the same x%2 parity as self.directions
+        neighbors = self.hex_neighbor_table[self.position_to_cell(position[0],position[1])]
+        return [[int(x),int(y)] for x,y in zip(*self.cell_to_position(neighbors[neighbors!=NO_CELL]))]
      
     def get_position_in_direction(self,position,direction):
         x=position[0]
         y=position[1]
-        delta = self.directions[x%2][direction]
+        delta = self.direction_steps[x%2][direction]
         return [x+delta[0],y+delta[1]]
           
     def raycast_in_direction(self,position,direction,ray_length,validity_required=True):
+        if(validity_required and self.check_position_valid(position)):
+            ray = self.get_ray_table(ray_length)[self.position_to_cell(position[0],position[1]),direction]
+            xs,ys = self.cell_to_position(ray[ray!=NO_CELL])
+            return [[int(x),int(y)] for x,y in zip(xs,ys)]
         ray_positions = []
         last_position = position
         for i in range(ray_length):
@@ -383,26 +1178,179 @@ class Grid():
     def get_position_objects(self,position_list):
         return [self.grid[x,y] for x,y in position_list]
     
+    def get_position_stats(self,position_list):
+        #Rows of [food,positive_pher,negative_pher,forage_pher,nest_value] per position
+        xs = np.array([pos[0] for pos in position_list],dtype=np.int64)
+        ys = np.array([pos[1] for pos in position_list],dtype=np.int64)
+        return self.gather_stats(xs,ys)
+    
+    def gather_cell_stats(self,cells):
+        stats = np.empty(np.shape(cells)+(5,),dtype=np.float32)
+        stats[...,0] = self.food.reshape(-1)[cells]
+        if(self.lazy_decay or self.pheromone_scale is not None):
+            positive_pher,negative_pher,forage_pher = self.pheromone_values(cells)
+            stats[...,1] = positive_pher
+            stats[...,2] = negative_pher
+            stats[...,3] = forage_pher
+        else:
+            stats[...,1] = self.positive_pher.reshape(-1)[cells]
+            stats[...,2] = self.negative_pher.reshape(-1)[cells]
+            stats[...,3] = self.forage_pher.reshape(-1)[cells]
+        stats[...,4] = self.nest_value.reshape(-1)[cells]
+        return stats
+    
+    def gather_stats(self,xs,ys):
+        if(self.lazy_decay or self.pheromone_scale is not None):
+            return self.gather_cell_stats(self.position_to_cell(xs,ys))
+        stats = np.empty(np.shape(xs)+(5,),dtype=np.float32)
+        stats[...,0] = self.food[xs,ys]
+        stats[...,1] = self.positive_pher[xs,ys]
+        stats[...,2] = self.negative_pher[xs,ys]
+        stats[...,3] = self.forage_pher[xs,ys]
+        stats[...,4] = self.nest_value[xs,ys]
+        return stats
+    
+    def check_positions_valid(self,xs,ys):
+        #Vectorised check_agent_position_valid
+        in_bounds = (xs>=0) & (xs<self.grid_size[0]) & (ys>=0) & (ys<self.grid_size[1])
+        valid = np.zeros(np.shape(xs),dtype=bool)
+        valid[in_bounds] = self.type[xs[in_bounds],ys[in_bounds]]!=SpaceType.WALL.value
+        return valid
+    
+    def deposit_pheromone(self,layer,xs,ys,amount):
+        #Deposits saturate at 1, repeated deposits on one cell add before clipping
+        cells = self.position_to_cell(xs,ys)
+        self.refresh_pheromone_cells(cells)
+        if(self.pheromone_scale is None):
+            np.add.at(layer,(xs,ys),amount)
+            layer[xs,ys] = np.minimum(layer[xs,ys],1)
+            return
+        cells,counts = np.unique(cells,return_counts=True)
+        flat = layer.reshape(-1)
+        quantum = int(round(amount*self.pheromone_scale))
+        flat[cells] = np.minimum(flat[cells].astype(np.int64)+counts*quantum,self.pheromone_scale)
+    
     def iterate_grid(self):
-        for space in self.grid.flatten():
-            space.iterate_space()
+        self.decay_tick += 1
+        if(not self.lazy_decay):
+            self.decay_pheromone_rows(0,self.grid_size[0])
+            
+    def decay_pheromone_rows(self,start,stop):
+        #One tick of eager decay for rows start:stop
+        factors = self.get_pheromone_decay_factors()
+        if(self.pheromone_scale is None):
+            self.pheromones[:,start:stop] *= factors
+            return
+        num_columns = self.grid_size[1]
+        for chunk_start,chunk_stop in self.row_chunks(start,stop):
+            decay_fixed_point(self.pheromones[:,chunk_start:chunk_stop],factors,
+                              np.arange(chunk_start*num_columns,chunk_stop*num_columns).reshape(-1,num_columns),
+                              self.decay_tick)
+    
+class GridSpaceArray():
+    #Compatibility view so grid.grid[x,y] and grid.grid.flatten() still yield GridSpace objects
+    
+    def __init__(self,grid):
+        self.grid = grid
+        self.shape = (grid.grid_size[0],grid.grid_size[1])
+        
+    def __getitem__(self,index):
+        return GridSpace(self.grid,int(index[0]),int(index[1]))
+    
+    def flatten(self):
+        spaces = np.empty(self.shape[0]*self.shape[1],dtype=object)
+        spaces[:] = [GridSpace(self.grid,x,y) for x in range(self.shape[0]) for y in range(self.shape[1])]
+        return spaces
     
 class GridSpace():
-     
+    #Lightweight view of one cell, reads and writes go straight to the Grid arrays
+    __slots__ = ("grid","x","y")
     
-    def __init__(self,x,y) :
+    def __init__(self,grid,x,y) :
+        self.grid = grid
         self.x = x
         self.y = y
-        self.type = SpaceType.EMPTY
-        self.nest = None
-        self.nest_value = 0
-        self.food = 0
-        self.positive_pher = 0
-        self.negative_pher = 0
-        self.forage_pher = 0
-        self.pos_pher_decay_rate = 0.05
-        self.forage_pher_decay_rate = 0.2
-        self.neg_pher_decay_rate = 0.3
+        
+    def __eq__(self,other):
+        return (isinstance(other,GridSpace) and self.grid is other.grid
+                and self.x==other.x and self.y==other.y)
+    
+    def __hash__(self):
+        return hash((self.x,self.y))
+    
+    @property
+    def type(self):
+        return SpaceType(int(self.grid.type[self.x,self.y]))
+    
+    @type.setter
+    def type(self,space_type):
+        self.grid.set_space_type([self.x,self.y],space_type)
+        
+    @property
+    def nest(self):
+        nest_id = self.grid.nest_id[self.x,self.y]
+        if(nest_id<0):
+            return None
+        return self.grid.nests[nest_id]
+    
+    @nest.setter
+    def nest(self,nest):
+        if(nest is None):
+            self.grid.nest_id[self.x,self.y] = -1
+        else:
+            self.grid.nest_id[self.x,self.y] = self.grid.register_nest(nest)
+    
+    @property
+    def nest_value(self):
+        return int(self.grid.nest_value[self.x,self.y])
+    
+    @nest_value.setter
+    def nest_value(self,nest_value):
+        self.grid.nest_value[self.x,self.y] = nest_value
+        
+    @property
+    def food(self):
+        return float(self.grid.food[self.x,self.y])
+    
+    @food.setter
+    def food(self,food):
+        self.grid.food[self.x,self.y] = food
+        
+    @property
+    def positive_pher(self):
+        return self.grid.get_pheromone(0,self.x,self.y)
+    
+    @positive_pher.setter
+    def positive_pher(self,value):
+        self.grid.set_pheromone(0,self.x,self.y,value)
+        
+    @property
+    def negative_pher(self):
+        return self.grid.get_pheromone(1,self.x,self.y)
+    
+    @negative_pher.setter
+    def negative_pher(self,value):
+        self.grid.set_pheromone(1,self.x,self.y,value)
+        
+    @property
+    def forage_pher(self):
+        return self.grid.get_pheromone(2,self.x,self.y)
+    
+    @forage_pher.setter
+    def forage_pher(self,value):
+        self.grid.set_pheromone(2,self.x,self.y,value)
+        
+    @property
+    def pos_pher_decay_rate(self):
+        return self.grid.pos_pher_decay_rate
+    
+    @property
+    def forage_pher_decay_rate(self):
+        return self.grid.forage_pher_decay_rate
+    
+    @property
+    def neg_pher_decay_rate(self):
+        return self.grid.neg_pher_decay_rate
         
     def add_food(self,food_to_add):
         self.food+=food_to_add
@@ -420,6 +1368,32 @@ class GridSpace():
         
 
     
+def build_scenario(grid_size,perlin_octaves,wall_threshold,num_nests,nest_rad,nest_agent_num,
+                   num_food,food_rad,food_density=0.5,seed=None,batch_mode=False,
+                   agent_parameters=None,terrain_cache_dir=None,noise_field=None,lazy_decay=False,rng=None,
+                   perception_mode="rays",pheromone_dtype="float32",storage_dir=None):
+    #Scenario setup shared by colony_vis.main and the headless runner
+    #The seed fixes the terrain and, unless a SimulationRNG is given, every random draw of the run
+    if(rng is None):
+        rng = SimulationRNG(seed)
+    grid = Grid(grid_size,perlin_octaves,wall_threshold,seed=seed,terrain_cache_dir=terrain_cache_dir,
+                noise_field=noise_field,lazy_decay=lazy_decay,rng=rng,pheromone_dtype=pheromone_dtype,
+                storage_dir=storage_dir)
+    agents = AgentManager(grid,batch_mode=batch_mode,agent_parameters=agent_parameters,perception_mode=perception_mode)
+    for i in range(num_nests):
+        spawn_point = agents.grid.find_random_valid_circle(nest_rad)
+        if(spawn_point!=None):
+            pos = [spawn_point.x,spawn_point.y]
+            agents.spawn_agents_around_point(nest_agent_num, pos,nest_rad)
+            agents.create_nest_around_point(pos,nest_rad)
+        
+    for i in range(num_food):
+        spawn_point = agents.grid.find_random_valid_circle(food_rad)
+        if(spawn_point!=None):
+            pos = [spawn_point.x,spawn_point.y]
+            agents.grid.add_food_cluster(pos,food_rad,food_density)
+    return agents
+    
 def main():
     grid_size = [100,100]
     perlin_octaves = 10
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the simulation hot paths, swept over grid sizes and agent counts.
+
+Every case reports calls per second, per call latency percentiles and the peak
+memory traced by tracemalloc. Results are written as JSON and can be compared
+against a saved baseline, any case whose median latency or peak memory grows by
+more than the tolerance is reported and the run exits with status 1.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --baseline bench.json
+    python benchmark.py --baseline bench.json --update-baseline
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+from ant_colony import AgentManager, Grid, build_scenario
+from cell_colours import ColourLUT
+from ensemble import Ensemble
+from terrain import load_noise_field
+from trajectory import frame_from_agents
+
+BASELINE_VERSION = 1
+DEFAULT_GRID_SIZES = [[82,39],[200,200]]
+DEFAULT_AGENT_COUNTS = [25,500,5000]
+PERLIN_OCTAVES = 3
+WALL_THRESHOLD = 0.05
+NUM_NESTS = 5
+
+
+def build_benchmark_scenario(grid_size,num_agents,batch_mode=True,seed=1,lazy_decay=False,perception_mode="rays",
+                             pheromone_dtype="float32"):
+    #Same layout as colony_vis with the colony split evenly over the nests
+    return build_scenario(grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,NUM_NESTS,4,max(1,num_agents//NUM_NESTS),
+                          7,3,0.5,seed=seed,batch_mode=batch_mode,lazy_decay=lazy_decay,perception_mode=perception_mode,
+                          pheromone_dtype=pheromone_dtype)
+
+def case_iterate_system(grid_size,num_agents,batch_mode,lazy_decay=False,perception_mode="rays"):
+    agents = build_benchmark_scenario(grid_size,num_agents,batch_mode,lazy_decay=lazy_decay,perception_mode=perception_mode)
+    return agents.iterate_system
+
+def case_iterate_ensemble(grid_size,num_agents,num_replicas=64):
+    #One tick of num_replicas small colonies (five agents a nest) stepped as a single batch
+    ensemble = Ensemble(num_replicas,grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,NUM_NESTS,4,5,7,3,0.5,seed=1)
+    return ensemble.step
+
+def case_agent_behaviour(grid_size,num_agents):
+    #One call per live agent, cycling through the colony
+    agents = build_benchmark_scenario(grid_size,num_agents,batch_mode=False)
+    state = {"next":0}
+    def step():
+        agent = agents.agents[state["next"]%len(agents.agents)]
+        state["next"] += 1
+        if(agent.is_alive):
+            agents.agent_behaviour(agent)
+    return step
+
+def case_iterate_grid(grid_size,num_agents,pheromone_dtype="float32"):
+    agents = build_benchmark_scenario(grid_size,num_agents,pheromone_dtype=pheromone_dtype)
+    return agents.grid.iterate_grid
+
+def case_grid_init(grid_size,num_agents):
+    #Includes terrain generation, nothing is cached between calls
+    return lambda:Grid(grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,seed=1)
+
+def case_circle_positions(grid_size,num_agents):
+    #Radius of the disc spawn_agents_around_point would pick for the whole colony
+    grid = Grid(grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,seed=1)
+    radius = spawn_radius(num_agents)
+    centre = [grid_size[0]//2,grid_size[1]//2]
+    return lambda:grid.get_circle_positions_around_point(centre,radius)
+
+def case_spawn_agents(grid_size,num_agents):
+    #Spawns the whole colony around the centre of a fresh AgentManager each call
+    noise_field = load_noise_field(grid_size,PERLIN_OCTAVES,1)
+    grid = Grid(grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,seed=1,noise_field=noise_field)
+    centre = [grid_size[0]//2,grid_size[1]//2]
+    def spawn():
+        agents = AgentManager(grid)
+        agents.spawn_agents_around_point(num_agents,centre)
+    return spawn
+
+def case_scenario_layout(grid_size,num_agents):
+    #Nest, colony and food placement on a fresh grid, the terrain noise is generated once
+    noise_field = load_noise_field(grid_size,PERLIN_OCTAVES,1)
+    return lambda:build_scenario(grid_size,PERLIN_OCTAVES,WALL_THRESHOLD,NUM_NESTS,4,max(1,num_agents//NUM_NESTS),
+                                 7,3,0.5,seed=1,noise_field=noise_field)
+
+def case_frame_build(grid_size,num_agents):
+    #The per tick work of HexGrid.iterate_system apart from the Tk calls
+    agents = build_benchmark_scenario(grid_size,num_agents)
+    for tick in range(20):
+        agents.iterate_system()
+    colour_lut = ColourLUT()
+    return lambda:colour_lut.frame_indices(frame_from_agents(agents))
+
+def spawn_radius(num_agents,desired_density=0.4):
+    desired_spaces = int(num_agents/desired_density)
+    radius = 0
+    while(3*radius*(radius+1)+1<=desired_spaces):
+        radius += 1
+    return radius
+
+#name -> (setup(grid_size,num_agents) returning the callable to time, whether it depends on num_agents)
+BENCHMARK_CASES = {
+    "iterate_system_batch":(lambda grid_size,num_agents:case_iterate_system(grid_size,num_agents,True),True),
+    "iterate_system_lazy_decay":(lambda grid_size,num_agents:case_iterate_system(grid_size,num_agents,True,True),True),
+    "iterate_system_fields":(lambda grid_size,num_agents:case_iterate_system(grid_size,num_agents,True,
+                                                                             perception_mode="fields"),True),
+    "iterate_system_per_agent":(lambda grid_size,num_agents:case_iterate_system(grid_size,num_agents,False),True),
+    "iterate_ensemble_64":(case_iterate_ensemble,False),
+    "agent_behaviour":(case_agent_behaviour,True),
+    "iterate_grid":(case_iterate_grid,False),
+    "iterate_grid_uint8":(lambda grid_size,num_agents:case_iterate_grid(grid_size,num_agents,"uint8"),False),
+    "grid_init":(case_grid_init,False),
+    "circle_positions":(case_circle_positions,True),
+    "spawn_agents":(case_spawn_agents,True),
+    "scenario_layout":(case_scenario_layout,True),
+    "frame_build":(case_frame_build,True),
+}
+
+def case_key(name,grid_size,num_agents):
+    return "%s/%dx%d/%d" % (name,grid_size[0],grid_size[1],num_agents)
+
+def time_case(setup,grid_size,num_agents,min_repeats=5,max_repeats=200,max_seconds=2.0,warmup=2):
+    function = setup(grid_size,num_agents)
+    for i in range(warmup):
+        function()
+    latencies = []
+    start = time.perf_counter()
+    while(len(latencies)<max_repeats):
+        call_start = time.perf_counter()
+        function()
+        latencies.append(time.perf_counter()-call_start)
+        if(len(latencies)>=min_repeats and time.perf_counter()-start>max_seconds):
+            break
+    latencies = np.array(latencies)
+    #Peak memory is traced separately, tracemalloc slows allocation heavy code down.
+    #The warmup call keeps lazily built caches such as the ray tables out of the peak.
+    tracemalloc.start()
+    try:
+        function = setup(grid_size,num_agents)
+        if(warmup>0):
+            function()
+        tracemalloc.reset_peak()
+        baseline_memory = tracemalloc.get_traced_memory()[0]
+        function()
+        peak_memory = tracemalloc.get_traced_memory()[1]-baseline_memory
+    finally:
+        tracemalloc.stop()
+    return {"repeats":len(latencies),"calls_per_second":float(len(latencies)/latencies.sum()),
+            "mean_ms":float(latencies.mean()*1e3),"p50_ms":float(np.percentile(latencies,50)*1e3),
+            "p90_ms":float(np.percentile(latencies,90)*1e3),"p99_ms":float(np.percentile(latencies,99)*1e3),
+            "max_ms":float(latencies.max()*1e3),"peak_memory_bytes":int(peak_memory)}
+
+def run_benchmarks(grid_sizes=None,agent_counts=None,cases=None,max_seconds=2.0,on_result=None):
+    grid_sizes = grid_sizes or DEFAULT_GRID_SIZES
+    agent_counts = agent_counts or DEFAULT_AGENT_COUNTS
+    cases = cases or list(BENCHMARK_CASES)
+    results = {}
+    for name in cases:
+        setup,uses_agents = BENCHMARK_CASES[name]
+        for grid_size in grid_sizes:
+            for num_agents in (agent_counts if uses_agents else [0]):
+                if(num_agents>grid_size[0]*grid_size[1]//4):
+                    continue
+                key = case_key(name,grid_size,num_agents)
+                result = {"case":name,"grid_size":list(grid_size),"num_agents":num_agents}
+                result.update(time_case(setup,grid_size,num_agents,max_seconds=max_seconds))
+                results[key] = result
+                if(on_result is not None):
+                    on_result(key,result)
+    return {"version":BASELINE_VERSION,"created":time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "machine":machine_info(),"results":results}
+
+def machine_info():
+    return {"platform":platform.platform(),"processor":platform.processor(),
+            "python":platform.python_version(),"numpy":np.__version__}
+
+def compare_to_baseline(current,baseline,time_tolerance=0.25,memory_tolerance=0.25,memory_slack=64*1024):
+    #Returns a list of regression messages, cases missing from either side are skipped
+    regressions = []
+    for key,result in current["results"].items():
+        if(key not in baseline["results"]):
+            continue
+        reference = baseline["results"][key]
+        if(result["p50_ms"]>reference["p50_ms"]*(1+time_tolerance)):
+            regressions.append("%s: median %.3fms -> %.3fms (%+.0f%%)" % (key,reference["p50_ms"],result["p50_ms"],
+                               100*(result["p50_ms"]/reference["p50_ms"]-1)))
+        memory_limit = reference["peak_memory_bytes"]*(1+memory_tolerance)+memory_slack
+        if(result["peak_memory_bytes"]>memory_limit):
+            regressions.append("%s: peak memory %d -> %d bytes" % (key,reference["peak_memory_bytes"],
+                               result["peak_memory_bytes"]))
+    return regressions
+
+def format_result(key,result):
+    return "%-45s %10.1f/s  p50 %9.3fms  p90 %9.3fms  p99 %9.3fms  peak %8.1fKiB" % (
+        key,result["calls_per_second"],result["p50_ms"],result["p90_ms"],result["p99_ms"],
+        result["peak_memory_bytes"]/1024)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ant colony hot paths")
+    parser.add_argument("--grid-sizes",type=int,nargs="+",default=None,metavar="X Y",
+                        help="flat list of grid sizes, e.g. 82 39 200 200")
+    parser.add_argument("--agent-counts",type=int,nargs="+",default=None)
+    parser.add_argument("--cases",nargs="+",default=None,choices=list(BENCHMARK_CASES))
+    parser.add_argument("--max-seconds",type=float,default=2.0,help="time budget per case")
+    parser.add_argument("--output",default=None,help="write this run's results as JSON")
+    parser.add_argument("--baseline",default=None,help="JSON results to compare against")
+    parser.add_argument("--update-baseline",action="store_true",help="overwrite --baseline with this run")
+    parser.add_argument("--time-tolerance",type=float,default=0.25)
+    parser.add_argument("--memory-tolerance",type=float,default=0.25)
+    args = parser.parse_args(argv)
+    grid_sizes = None
+    if(args.grid_sizes is not None):
+        if(len(args.grid_sizes)%2!=0):
+            parser.error("--grid-sizes takes pairs of X Y")
+        grid_sizes = [args.grid_sizes[i:i+2] for i in range(0,len(args.grid_sizes),2)]
+
+    current = run_benchmarks(grid_sizes,args.agent_counts,args.cases,args.max_seconds,
+                             on_result=lambda key,result:print(format_result(key,result),flush=True))
+    if(args.output is not None):
+        with open(args.output,"w") as output_file:
+            json.dump(current,output_file,indent=2)
+    if(args.baseline is None):
+        return current
+    if(args.update_baseline):
+        with open(args.baseline,"w") as baseline_file:
+            json.dump(current,baseline_file,indent=2)
+        print("Baseline written to " + args.baseline)
+        return current
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if(baseline.get("machine")!=current["machine"]):
+        print("Warning: baseline was recorded on a different machine or environment")
+    regressions = compare_to_baseline(current,baseline,args.time_tolerance,args.memory_tolerance)
+    if(regressions):
+        print("PERFORMANCE REGRESSION against " + args.baseline)
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+    print("No regressions against " + args.baseline)
+    return current
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Colour lookup table shared by the Tk view and the raster renderer.
+
+Every cell maps to one integer colour index: fixed entries for walls, nests and
+agents, then one entry per quantised food level and one per combination of
+quantised pheromone levels. Colours match the white -> food colour and the
+positive -> forage -> negative pheromone blending that colony_vis has always used.
+"""
+
+import numpy as np
+from ant_colony import SpaceType
+
+WALL_COLOUR = (0x00,0x00,0x00)
+NEST_COLOUR = (0x61,0xd4,0x4a)
+AGENT_COLOUR = (0xa2,0xa3,0x4b)
+EMPTY_COLOUR = (0xff,0xff,0xff)
+FOOD_MAX_COLOUR = (0xfc,0xba,0x03)
+POS_PHER_MAX_COLOUR = (0x42,0x87,0xf5)
+FOR_PHER_MAX_COLOUR = (0xf5,0x42,0xf5)
+NEG_PHER_MAX_COLOUR = (0xff,0x0d,0x2d)
+
+WALL_INDEX = 0
+NEST_INDEX = 1
+AGENT_INDEX = 2
+FOOD_OFFSET = 3
+
+
+def lerp_rgb(a,b,t):
+    #Linear blend from a to b truncated to integers, vectorised over t
+    t = np.asarray(t)[...,None]
+    return (t*(np.asarray(b)-np.asarray(a))+np.asarray(a)).astype(np.int64)
+
+class ColourLUT():
+
+    def __init__(self,levels=32):
+        self.levels = levels
+        self.pher_offset = FOOD_OFFSET+levels
+        t = np.arange(levels)/(levels-1)
+        food_colours = lerp_rgb(EMPTY_COLOUR,FOOD_MAX_COLOUR,t)
+        pos_t,for_t,neg_t = [level.reshape(-1) for level in np.meshgrid(t,t,t,indexing="ij")]
+        pher_colours = lerp_rgb(EMPTY_COLOUR,POS_PHER_MAX_COLOUR,pos_t)
+        pher_colours = lerp_rgb(pher_colours,FOR_PHER_MAX_COLOUR,for_t)
+        pher_colours = lerp_rgb(pher_colours,NEG_PHER_MAX_COLOUR,neg_t)
+        self.rgb = np.concatenate([np.array([WALL_COLOUR,NEST_COLOUR,AGENT_COLOUR]),
+                                   food_colours,pher_colours]).astype(np.uint8)
+        self.hex = ['#%02x%02x%02x' % tuple(colour) for colour in self.rgb.tolist()]
+
+    def quantize(self,values):
+        return np.rint(np.clip(values,0,1)*(self.levels-1)).astype(np.int64)
+
+    def cell_indices(self,space_types,layers):
+        #space_types and layers ([food,positive_pher,negative_pher,forage_pher]) as flat arrays
+        food,positive_pher,negative_pher,forage_pher = layers
+        pher_index = self.pher_offset+(self.quantize(positive_pher)*self.levels
+                                       +self.quantize(forage_pher))*self.levels+self.quantize(negative_pher)
+        indices = np.where(food>0,FOOD_OFFSET+self.quantize(food),pher_index)
+        indices[space_types==SpaceType.WALL.value] = WALL_INDEX
+        indices[space_types==SpaceType.NEST.value] = NEST_INDEX
+        return indices
+
+    def frame_indices(self,frame):
+        #Colour index per flat cell for a colony_vis frame, agents drawn on top
+        grid_size = frame["type"].shape
+        indices = self.cell_indices(frame["type"].reshape(-1),frame["layers"].reshape(4,-1))
+        positions = np.asarray(frame["agent_positions"]).reshape(-1,2)[np.asarray(frame["agent_alive"],dtype=bool)]
+        indices[positions[:,0]*grid_size[1]+positions[:,1]] = AGENT_INDEX
+        return indices
@@ -6,28 +6,48 @@ Created on Mon Mar 21 13:08:15 2022
 @author: cfletcher1
 """
 
-from tkinter import Tk, Canvas, Frame, BOTH
-from ant_colony import AgentManager,Grid, SpaceType
+from tkinter import Tk, Canvas, Frame, Button, Scale, BOTH, HORIZONTAL, LEFT, X
+from ant_colony import build_scenario
+from cell_colours import ColourLUT
+from hex_geometry import calculate_hexpoints_from_tl, calculate_cartesian_grid_position
+from sim_thread import SimulationThread
+from trajectory import TrajectoryReader, frame_from_agents
 from math import sin,cos,pi
+import argparse
 import time
+import numpy as np
 
 class HexGrid(Frame):
     
-    def __init__(self,agents):
+    def __init__(self,agents=None,replay=None,simulation=None,fps=30,max_ticks=10000):
         super().__init__()
-        self.initUI(agents)
+        self.initUI(agents,replay,simulation,fps,max_ticks)
         
-    def initUI(self,agents):
+    def initUI(self,agents,replay,simulation=None,fps=30,max_ticks=10000):
+        #Draws either a live AgentManager, a SimulationThread's frames at a fixed fps or, when
+        #replay is a TrajectoryReader, a recorded run
         self.master.title("Ant Colony Hex Grid")
         self.pack(fill=BOTH,expand=1)
         self.canvas = Canvas(self)
+        if(simulation is not None):
+            agents = simulation.agents
         self.agents = agents
+        self.replay = replay
+        self.simulation = simulation
+        self.frame_interval_ms = max(1,int(round(1000/fps)))
+        self.max_ticks = max_ticks
         self.timer = 0
+        if(replay is not None):
+            grid_size = replay.grid_size
+            nest_centers = replay.nest_centres
+        else:
+            grid_size = agents.grid.grid_size
+            nest_centers = [nest.centre_position for nest in agents.grid.nests]
         
         r = 20
         start_position = [sin(pi/6)*r,0]
-        self.grid_spaces = agents.grid.grid.flatten()
-        xy_positions = [[space.x,space.y] for space in self.grid_spaces]
+        #Hexes are created in flat cell order, cell id x*grid_size[1]+y
+        xy_positions = [[x,y] for x in range(grid_size[0]) for y in range(grid_size[1])]
         uv_positions = [calculate_cartesian_grid_position(x,y,r) for x,y in xy_positions]
         uv_positions = [[start_position[0]+u,start_position[1]+v] for u,v in uv_positions]
         hexpoints_positions = [calculate_hexpoints_from_tl(u,v,r) for u,v in uv_positions]
@@ -36,124 +56,167 @@ class HexGrid(Frame):
         self.canvas_hexes = [self.canvas.create_polygon(points,
                                               outline='#000000',fill='#ed5876',width=1) for points in hexpoints_positions]
         #[self.canvas.create_text(uv[0]+r/2,uv[1]+r*cos(pi/6),text=str(xy),font=('Helvetica 5 bold')) for uv,xy in zip(uv_positions,xy_positions)]
-        self.grid_to_hex = dict(zip(self.grid_spaces,self.canvas_hexes))
-        #canvas.pack(fill=BOTH,expand=1)
-        #print(self.grid_spaces[0].position,self.grid_to_hex[self.grid_spaces[0]])
         
-        nest_centers = [nest.centre_position for nest in agents.nests]
         nest_text_positions = [calculate_cartesian_grid_position(x, y, r) for x,y in nest_centers]
         nest_text_centers = [[u+r/2,v+r*cos(pi/6)] for u,v in nest_text_positions]
-        nest_text = [self.canvas.create_text(u,v,text="0",font=('Helvetica 20 bold')) for u,v in nest_text_centers]
-        self.nest_to_text = dict(zip(agents.nests,nest_text))
+        self.nest_text = [self.canvas.create_text(u,v,text="0",font=('Helvetica 20 bold')) for u,v in nest_text_centers]
         
-        self.iterate_system()
+        #Colour index currently shown on each hex, only hexes whose index changes are reconfigured
+        self.colour_lut = ColourLUT()
+        self.drawn_colours = np.full(len(self.canvas_hexes),-1,dtype=np.int64)
+        self.drawn_nest_food = [None]*len(self.nest_text)
+        
+        if(replay is not None):
+            self.init_replay_controls()
+            self.replay_step()
+        elif(simulation is not None):
+            self.init_simulation_controls()
+            self.master.protocol("WM_DELETE_WINDOW",self.close)
+            simulation.start()
+            self.render_step()
+        else:
+            self.iterate_system()
         
     
             
         self.canvas.pack(fill=BOTH,expand=1)
         
     def iterate_system(self):
-        if(self.timer<10000):
+        if(self.timer<self.max_ticks):
             self.agents.iterate_system()
-                
-            for polygon,space in zip(self.canvas_hexes,self.grid_spaces):
-                
-                if(space.type == SpaceType.WALL):
-                    fill_colour = '#000000'
-                elif(space.type == SpaceType.NEST):
-                    fill_colour = '#61d44a'
-                else:
-                    fill_colour = '#FFFFFF'
-                    food_max_colour = '#fcba03'
-                    pos_pher_max_colour = '#4287f5'
-                    for_pher_max_colour = '#f542f5'
-                    neg_pher_max_colour = '#ff0d2d'
-                    if(space.food>0):
-                        fill_colour = lerp_hex(fill_colour,food_max_colour,min(1,space.food))
-                    else:
-                        if(space.positive_pher>0):
-                            fill_colour = lerp_hex(fill_colour,pos_pher_max_colour,space.positive_pher)
-                        if(space.forage_pher>0):
-                            fill_colour = lerp_hex(fill_colour,for_pher_max_colour,space.forage_pher)
-                        if(space.negative_pher>0):
-                            fill_colour = lerp_hex(fill_colour,neg_pher_max_colour,space.negative_pher)
-                        
-         
-                self.canvas.itemconfig(polygon,fill=fill_colour) 
-            
-            for agent in self.agents.agents:
-                position = agent.position
-                self.canvas.itemconfig(self.grid_to_hex[self.agents.grid.grid[position[0],position[1]]],fill='#a2a34b')
+            self.draw_frame(frame_from_agents(self.agents))
             self.after(1,self.iterate_system)
             self.timer+=1
             
-            for nest in self.agents.nests:
-                self.canvas.itemconfig(self.nest_to_text[nest],text=str(nest.food))
-        
-        
-def calculate_hexpoints_from_tl(u,v,r):
-    u_list = [0,1,1+sin(pi/6),1,0,-sin(pi/6)]
-    v_list = [0,0,cos(pi/6),2*cos(pi/6),2*cos(pi/6),cos(pi/6)]
-    points_list = []
-    for i in range(len(u_list)):
-        points_list.append(u+r*u_list[i])
-        points_list.append(v+r*v_list[i])
-    return points_list
+    def draw_frame(self,frame):
+        self.draw_colours(self.colour_lut.frame_indices(frame),frame["nest_food"])
+            
+    def draw_colours(self,colours,nest_food_values):
+        #Agents are part of the colour index, so a move dirties both the old and new hex
+        lut_hex = self.colour_lut.hex
+        for cell in np.nonzero(colours!=self.drawn_colours)[0].tolist():
+            self.canvas.itemconfig(self.canvas_hexes[cell],fill=lut_hex[colours[cell]]) 
+        self.drawn_colours = colours
+        
+        for nest_index,(text,nest_food) in enumerate(zip(self.nest_text,nest_food_values)):
+            if(nest_food!=self.drawn_nest_food[nest_index]):
+                self.canvas.itemconfig(text,text=str(nest_food))
+                self.drawn_nest_food[nest_index] = nest_food
+            
+    def init_simulation_controls(self):
+        #Ticks simulated per published frame, read by the simulation thread before each frame
+        controls = Frame(self)
+        controls.pack(fill=X)
+        self.ticks_scale = Scale(controls,from_=1,to=1000,orient=HORIZONTAL,label="Ticks per frame",
+                                 command=lambda value:setattr(self.simulation,"ticks_per_frame",int(float(value))))
+        self.ticks_scale.set(self.simulation.ticks_per_frame)
+        self.ticks_scale.pack(side=LEFT,fill=X,expand=1)
+        
+    def render_step(self):
+        #Draws the newest frame the simulation thread published, stale ones are dropped, and
+        #reschedules itself so redraws start frame_interval_ms apart however long they take
+        start = time.perf_counter()
+        frame = self.simulation.latest_frame()
+        if(frame is not None):
+            self.draw_colours(frame["colours"],frame["nest_food"])
+            self.master.title("Ant Colony Hex Grid - tick " + str(frame["tick"]))
+        elapsed_ms = int((time.perf_counter()-start)*1000)
+        if(self.simulation.is_running() or not self.simulation.frames.empty()):
+            self.after(max(1,self.frame_interval_ms-elapsed_ms),self.render_step)
+        
+    def close(self):
+        self.simulation.stop()
+        self.master.destroy()
+            
+    def init_replay_controls(self):
+        #Play/pause, seek and speed controls. Speed is in records per redraw, values
+        #above 1 skip records and values below 1 hold each record for several redraws.
+        self.replay_position = 0.0
+        self.replay_playing = True
+        self.replay_interval_ms = 30
+        self.drawn_record = None
+        #Flat layers of drawn_record, carried forward while playing so each delta is read once
+        self.replay_layers = None
+        controls = Frame(self)
+        controls.pack(fill=X)
+        self.play_button = Button(controls,text="Pause",command=self.toggle_replay)
+        self.play_button.pack(side=LEFT)
+        self.seek_scale = Scale(controls,from_=0,to=max(0,self.replay.num_records-1),orient=HORIZONTAL,
+                                label="Record",command=self.on_seek_scale)
+        self.seek_scale.pack(side=LEFT,fill=X,expand=1)
+        self.speed_scale = Scale(controls,from_=0.1,to=1000,resolution=0.1,orient=HORIZONTAL,label="Records per frame")
+        self.speed_scale.set(1)
+        self.speed_scale.pack(side=LEFT)
+        self.master.bind("<space>",lambda event:self.toggle_replay())
+        self.master.bind("<Left>",lambda event:self.seek_replay(self.replay_position-1))
+        self.master.bind("<Right>",lambda event:self.seek_replay(self.replay_position+1))
+        
+    def toggle_replay(self):
+        self.replay_playing = not self.replay_playing
+        self.play_button.config(text="Pause" if self.replay_playing else "Play")
+        
+    def seek_replay(self,record_index):
+        self.replay_position = min(max(0.0,float(record_index)),self.replay.num_records-1)
+        
+    def on_seek_scale(self,value):
+        #Also fires when replay_step moves the slider, only seek on a real change of record
+        if(int(float(value))!=int(self.replay_position)):
+            self.seek_replay(int(float(value)))
+        
+    def replay_step(self):
+        if(self.replay_playing):
+            self.replay_position = min(self.replay_position+self.speed_scale.get(),self.replay.num_records-1)
+        record_index = int(self.replay_position)
+        if(record_index!=self.drawn_record):
+            if(self.replay_layers is not None and record_index>self.drawn_record):
+                self.replay_layers = self.replay.advance_layers(self.replay_layers,self.drawn_record,record_index)
+                frame = self.replay.frame(record_index,self.replay_layers.reshape((-1,)+self.replay.grid_size))
+            else:
+                #Seeking backwards rebuilds from the nearest snapshot
+                frame = self.replay.frame(record_index)
+                self.replay_layers = frame["layers"].reshape(len(frame["layers"]),-1)
+            self.draw_frame(frame)
+            self.drawn_record = record_index
+            self.seek_scale.set(record_index)
+            self.master.title("Ant Colony Hex Grid - tick " + str(frame["tick"]))
+        self.after(self.replay_interval_ms,self.replay_step)
+        
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ant colony hex grid viewer")
+    parser.add_argument("--replay",default=None,help="trajectory file to replay instead of simulating")
+    parser.add_argument("--threaded",action="store_true",
+                        help="simulate in a background thread and redraw its newest frame at --fps")
+    parser.add_argument("--fps",type=float,default=30)
+    parser.add_argument("--ticks-per-frame",type=int,default=1)
+    parser.add_argument("--ticks",type=int,default=10000)
+    args = parser.parse_args(argv)
     
+    root=Tk()
+    if(args.replay is not None):
+        hexGrid = HexGrid(replay=TrajectoryReader(args.replay))
+        root.mainloop()
+        return
     
-def calculate_cartesian_grid_position(x,y,r):  
-    if(x%2==0):
-        u=y*2*(sin(pi/6)+1)
-        v=x*cos(pi/6)
-    else:
-        u=(1+y*2)*(sin(pi/6)+1)
-        v=x*cos(pi/6)
-    return r*u,r*v
-  
-def lerp_hex(a,b,t):
-    a = hex_to_rgb(a)
-    b= hex_to_rgb(b)
-    x = int(t*(b[0]-a[0]) + a[0])
-    y = int(t*(b[1]-a[1]) + a[1])
-    z = int(t*(b[2]-a[2]) + a[2])
-    return rgb_to_hex((x,y,z))
-        
-def hex_to_rgb(h):
-    h = h.lstrip('#')
-    return tuple(int(h[i:i+2],16) for i in (0,2,4))
-
-def rgb_to_hex(rgb):
-    return '#%02x%02x%02x' % rgb
-
-def main():
     grid_size = [82,39]
     #82,39,r=20
     
     perlin_octaves = 3
     wall_threshold = 0.05
-    grid = Grid(grid_size,perlin_octaves,wall_threshold)
-    agents = AgentManager(grid)
     
     num_nests = 5
     nest_rad = 4
     nest_agent_num = 5
     num_food = 7
     food_rad = 3
-    for i in range(num_nests):
-        spawn_point = agents.grid.find_random_valid_circle(nest_rad)
-        if(spawn_point!=None):
-            pos = [spawn_point.x,spawn_point.y]
-            agents.spawn_agents_around_point(nest_agent_num, pos,nest_rad)
-            agents.create_nest_around_point(pos,nest_rad)
-        
-    for i in range(num_food):
-        spawn_point = agents.grid.find_random_valid_circle(food_rad)
-        if(spawn_point!=None):
-            pos = [spawn_point.x,spawn_point.y]
-            agents.grid.add_food_cluster(pos,food_rad,0.5)
+    agents = build_scenario(grid_size,perlin_octaves,wall_threshold,num_nests,nest_rad,
+                            nest_agent_num,num_food,food_rad,0.5)
             
-    root=Tk()
-    hexGrid = HexGrid(agents)
+    if(args.threaded):
+        simulation = SimulationThread(agents,ticks_per_frame=args.ticks_per_frame,max_ticks=args.ticks)
+        hexGrid = HexGrid(simulation=simulation,fps=args.fps)
+        root.mainloop()
+        return
+    hexGrid = HexGrid(agents,max_ticks=args.ticks)
     root.mainloop()
     hexGrid.iterate_system()
     
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Many independent replicas of one scenario stepped together in a single batch tick.
+
+The replicas share the terrain but each has its own SimulationRNG stream, and
+so its own nests, food, spawn points, pheromones and direction choices. They
+are stacked along the rows of one tall grid whose neighbour tables never cross
+from one replica into the next, so a single batch mode AgentManager steps every
+replica at once and the Python overhead of a tick is paid once for the whole
+ensemble. Replica r owns rows r*X:(r+1)*X of the stacked grid and, since the
+flat cell id is x*Y+y, flat cells r*X*Y:(r+1)*X*Y.
+
+Direction choices are hashed from (replica seed,tick,agent index within the
+replica) by counter_uniforms, so a replica steps exactly as it would on its
+own whatever the other replicas do.
+
+    ensemble = Ensemble(64,[82,39],3,0.05,5,4,5,7,3,seed=7)
+    ensemble.step(1000)
+    ensemble.nest_food()   #(64,num_nests) array
+"""
+
+import numpy as np
+from ant_colony import AgentManager, AgentState, Grid, Nest, PHEROMONE_LAYERS, NO_CELL, build_scenario, counter_uniforms
+from sim_rng import SimulationRNG
+
+
+class EnsembleAgentManager(AgentManager):
+    #Batch mode AgentManager over a stacked grid, drawing each agent's uniform from its replica's seed
+
+    def __init__(self,grid,replica_seeds,agent_parameters=None,rng=None,perception_mode="rays"):
+        super().__init__(grid,batch_mode=True,agent_parameters=agent_parameters,rng=rng,perception_mode=perception_mode)
+        self.replica_seeds = np.asarray(replica_seeds,dtype=np.uint64)
+        #Replica of every agent and its index among that replica's agents
+        self.agent_replica = np.zeros(0,dtype=np.int32)
+        self.replica_agent_ids = np.zeros(0,dtype=np.int64)
+
+    def batch_choose_directions(self,step,uniforms=None):
+        if(uniforms is None):
+            uniforms = counter_uniforms(self.replica_seeds[self.agent_replica[step.alive]],self.tick,
+                                        self.replica_agent_ids[step.alive])
+        super().batch_choose_directions(step,uniforms)
+
+def stack_replicas(replicas,replica_seeds,rng=None):
+    #One EnsembleAgentManager holding the fresh batch mode AgentManagers in replicas, which
+    #must share grid size, terrain, agent parameters and number of nests
+    first = replicas[0]
+    first_grid = first.grid
+    num_rows,num_columns = first_grid.grid_size
+    num_cells = num_rows*num_columns
+    num_replicas = len(replicas)
+    num_nests = len(first_grid.nests)
+    if(any(len(replica.grid.nests)!=num_nests for replica in replicas)):
+        raise ValueError("Every replica needs the same number of nests, the map has too little room for them")
+    grids = [replica.grid for replica in replicas]
+
+    arrays = {"type":np.concatenate([grid.type for grid in grids]),
+              "nest_id":np.concatenate([np.where(grid.nest_id>=0,grid.nest_id+replica*num_nests,-1).astype(grid.nest_id.dtype)
+                                        for replica,grid in enumerate(grids)]),
+              "nest_value":np.concatenate([grid.nest_value for grid in grids]),
+              "food":np.concatenate([grid.food for grid in grids]),
+              "pheromones":np.concatenate([grid.pheromones for grid in grids],axis=1)}
+    if(first_grid.lazy_decay):
+        arrays["pheromone_ticks"] = np.concatenate([grid.pheromone_ticks for grid in grids])
+    for name in ("hex_neighbor_table","neighbor_table"):
+        tables = [getattr(grid,name) for grid in grids]
+        arrays[name] = np.concatenate([np.where(table!=NO_CELL,table+replica*num_cells,NO_CELL).astype(table.dtype)
+                                       for replica,table in enumerate(tables)])
+    grid = Grid([num_replicas*num_rows,num_columns],first_grid.perlin_noise.octaves,0,seed=first_grid.seed,
+                noise_field=np.tile(first_grid.noise_field,(num_replicas,1)),lazy_decay=first_grid.lazy_decay,
+                decay_epsilon=first_grid.decay_epsilon,shared_arrays=arrays,rng=rng)
+    grid.pos_pher_decay_rate = first_grid.pos_pher_decay_rate
+    grid.neg_pher_decay_rate = first_grid.neg_pher_decay_rate
+    grid.forage_pher_decay_rate = first_grid.forage_pher_decay_rate
+    grid.decay_tick = first_grid.decay_tick
+
+    agents = EnsembleAgentManager(grid,replica_seeds,agent_parameters=first.castes[0],rng=rng,
+                                  perception_mode=first.perception_mode)
+    for agent_parameters in first.castes[1:]:
+        agents.add_caste(agent_parameters)
+    agents.max_capacity = first.max_capacity
+    for replica,replica_grid in enumerate(grids):
+        for nest in replica_grid.nests:
+            centre = [nest.centre_position[0]+replica*num_rows,nest.centre_position[1]]
+            stacked_nest = Nest(centre,[[x+replica*num_rows,y] for x,y in nest.grid_spaces])
+            stacked_nest.food = nest.food
+            grid.register_nest(stacked_nest)
+            agents.nests.append(stacked_nest)
+
+    counts = [len(replica.agents) for replica in replicas]
+    agents.ensure_agent_capacity(sum(counts))
+    agents.num_agents = sum(counts)
+    positions = np.concatenate([replica.agent_positions[:count] for replica,count in zip(replicas,counts)])
+    agents.agent_replica = np.repeat(np.arange(num_replicas,dtype=np.int32),counts)
+    positions[:,0] += agents.agent_replica*num_rows
+    agents.agent_positions[:agents.num_agents] = positions
+    for name in ("agent_directions","agent_states","agent_food","agent_alive","agent_caste"):
+        getattr(agents,name)[:agents.num_agents] = np.concatenate([getattr(replica,name)[:count]
+                                                                   for replica,count in zip(replicas,counts)])
+    agents.replica_agent_ids = np.concatenate([np.arange(count,dtype=np.int64) for count in counts])
+    agents.occupancy = np.concatenate([replica.occupancy for replica in replicas])
+    agents.tick = first.tick
+    return agents
+
+class Ensemble():
+    #num_replicas runs of build_scenario on one terrain, stepped as a single batch. Replica r
+    #is built with the r-th child of SimulationRNG(seed) (or of rng), seed also fixes the terrain.
+
+    def __init__(self,num_replicas,grid_size,perlin_octaves,wall_threshold,num_nests,nest_rad,nest_agent_num,
+                 num_food,food_rad,food_density=0.5,seed=None,agent_parameters=None,terrain_cache_dir=None,
+                 noise_field=None,lazy_decay=False,rng=None,perception_mode="rays",pheromone_dtype="float32"):
+        if(rng is None):
+            rng = SimulationRNG(seed)
+        self.num_replicas = num_replicas
+        self.replica_grid_size = list(grid_size)
+        self.replica_rngs = rng.spawn(num_replicas)
+        #The first replica generates (or loads) the terrain, the others are built on its noise field
+        replicas = []
+        for replica_rng in self.replica_rngs:
+            replica = build_scenario(grid_size,perlin_octaves,wall_threshold,num_nests,nest_rad,nest_agent_num,
+                                     num_food,food_rad,food_density,seed=seed,batch_mode=True,
+                                     agent_parameters=agent_parameters,terrain_cache_dir=terrain_cache_dir,
+                                     noise_field=noise_field,lazy_decay=lazy_decay,rng=replica_rng,
+                                     perception_mode=perception_mode,pheromone_dtype=pheromone_dtype)
+            noise_field = replica.grid.noise_field
+            replicas.append(replica)
+        self.replica_seeds = [replica_rng.counter_seed() for replica_rng in self.replica_rngs]
+        self.num_nests = len(replicas[0].grid.nests)
+        self.agents = stack_replicas(replicas,self.replica_seeds,rng)
+        self.grid = self.agents.grid
+
+    def step(self,num_ticks=1):
+        for tick in range(num_ticks):
+            self.agents.iterate_system()
+
+    def replica_rows(self,replica):
+        #Rows of the stacked grid that hold replica
+        num_rows = self.replica_grid_size[0]
+        return slice(replica*num_rows,(replica+1)*num_rows)
+
+    def replica_layer(self,layer):
+        #A (num_replicas,X,Y) view of a stacked grid sized layer, e.g. grid.food
+        return layer.reshape((self.num_replicas,)+tuple(self.replica_grid_size))
+
+    def nest_food(self):
+        #(num_replicas,num_nests) food delivered to each nest
+        return np.array([nest.food for nest in self.grid.nests],dtype=np.float64).reshape(self.num_replicas,self.num_nests)
+
+    def food_remaining(self):
+        return np.sum(self.replica_layer(self.grid.food),axis=(1,2),dtype=np.float64)
+
+    def pheromone_totals(self):
+        #(num_replicas,len(PHEROMONE_LAYERS)) total of each layer
+        pheromones = self.grid.get_pheromones().reshape((len(PHEROMONE_LAYERS),self.num_replicas,-1))
+        return np.sum(pheromones,axis=2,dtype=np.float64).T
+
+    def agents_per_state(self):
+        #(num_replicas,len(AgentState)) live agents in each state, columns in AgentState order
+        agents = self.agents
+        alive = agents.agent_alive[:agents.num_agents]
+        replicas = agents.agent_replica[alive]
+        states = agents.agent_states[:agents.num_agents][alive]
+        return np.stack([np.bincount(replicas[states==state.value],minlength=self.num_replicas)
+                         for state in AgentState],axis=1)
+
+    def summary(self):
+        #Per replica results as arrays with a leading num_replicas dimension
+        summary = {"nest_food":self.nest_food(),"food_remaining":self.food_remaining(),
+                   "agents_per_state":self.agents_per_state()}
+        pheromone_totals = self.pheromone_totals()
+        for layer_index,layer in enumerate(PHEROMONE_LAYERS):
+            summary[layer+"_total"] = pheromone_totals[:,layer_index]
+        return summary
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""
+Storage for the per-cell grid layers: optionally memory-mapped, and for the
+pheromone layers optionally at reduced precision.
+
+Pheromones live in [0,1] and can be stored as float32, float16, or as uint16 or
+uint8 fixed point with 1 represented by the largest integer. Fixed point
+values are rounded stochastically rather than to nearest, so a cell holding a
+few units still decays on average at the configured rate instead of getting
+stuck. The rounding offsets are an integer hash of (cell,layer,tick), so they
+cost no random draws and a tiled run rounds exactly like an in-process one.
+
+With a storage_dir every layer is a numpy .npy memmap in that directory. The
+files start sparse, so cells that are never touched never take up memory.
+"""
+
+import os
+import numpy as np
+
+PHEROMONE_DTYPES = ["float32","float16","uint16","uint8"]
+#Fixed point rounding resolution, offsets are in [0,DITHER_STEPS)
+DITHER_STEPS = 1<<16
+
+
+def allocate_layer(shape,dtype,fill=0,storage_dir=None,name=None):
+    #np.full, or a .npy memmap named name in storage_dir
+    if(storage_dir is None):
+        return np.full(shape,fill,dtype=dtype)
+    os.makedirs(storage_dir,exist_ok=True)
+    layer = np.lib.format.open_memmap(os.path.join(storage_dir,name+".npy"),mode="w+",dtype=dtype,shape=shape)
+    if(fill!=0):
+        layer[...] = fill
+    return layer
+
+def fixed_point_scale(dtype):
+    #The stored integer that stands for 1, None for float storage
+    dtype = np.dtype(dtype)
+    if(np.issubdtype(dtype,np.integer)):
+        return int(np.iinfo(dtype).max)
+    return None
+
+def dither(cells,tick,num_layers):
+    #(num_layers,)+cells.shape offsets in [0,DITHER_STEPS) for flat cells at tick, hashed
+    #with the lowbias32 finaliser so a cell's offsets are uncorrelated from tick to tick
+    cells = np.asarray(cells).astype(np.uint32)
+    layers = np.arange(num_layers,dtype=np.uint32).reshape((-1,)+(1,)*cells.ndim)
+    x = cells*np.uint32(0x9e3779b1)+layers*np.uint32(0x85ebca6b)+np.uint32(tick*0xc2b2ae35%(1<<32))
+    x ^= x>>np.uint32(16)
+    x *= np.uint32(0x7feb352d)
+    x ^= x>>np.uint32(15)
+    x *= np.uint32(0x846ca68b)
+    x ^= x>>np.uint32(16)
+    return x>>np.uint32(16)
+
+def decode_pheromones(stored):
+    #Stored pheromone values to float32 in [0,1], float32 storage is returned as is
+    scale = fixed_point_scale(stored.dtype)
+    if(scale is None):
+        return stored.astype(np.float32,copy=False)
+    return stored.astype(np.float32)/np.float32(scale)
+
+def encode_pheromones(values,dtype,cells,tick):
+    #float values in [0,1] for flat cells, shape (num_layers,)+cells.shape, to the storage dtype
+    scale = fixed_point_scale(dtype)
+    if(scale is None):
+        return np.asarray(values).astype(dtype)
+    offsets = dither(cells,tick,len(values))
+    scaled = np.floor(np.asarray(values,dtype=np.float64)*scale+offsets/DITHER_STEPS)
+    return np.clip(scaled,0,scale).astype(dtype)
+
+def decay_fixed_point(stored,factors,cells,tick):
+    #Multiplies fixed point layers (num_layers,)+cells.shape in place by the per layer factors,
+    #in integer arithmetic with the same dithered rounding as encode_pheromones
+    multipliers = np.round(np.asarray(factors,dtype=np.float64).reshape(-1)*DITHER_STEPS).astype(np.uint32)
+    multipliers = multipliers.reshape((-1,)+(1,)*(stored.ndim-1))
+    #At most 65535*65536+65535 for uint16 storage, which still fits in uint32
+    decayed = (stored.astype(np.uint32)*multipliers+dither(cells,tick,len(stored)))>>np.uint32(16)
+    stored[...] = decayed.astype(stored.dtype)
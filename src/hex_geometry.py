@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+"""
+Screen geometry of the hex grid, shared by the Tk view and the raster renderer.
+"""
+
+from math import sin,cos,pi
+
+
+def calculate_hexpoints_from_tl(u,v,r):
+    u_list = [0,1,1+sin(pi/6),1,0,-sin(pi/6)]
+    v_list = [0,0,cos(pi/6),2*cos(pi/6),2*cos(pi/6),cos(pi/6)]
+    points_list = []
+    for i in range(len(u_list)):
+        points_list.append(u+r*u_list[i])
+        points_list.append(v+r*v_list[i])
+    return points_list
+    
+    
+def calculate_cartesian_grid_position(x,y,r):  
+    if(x%2==0):
+        u=y*2*(sin(pi/6)+1)
+        v=x*cos(pi/6)
+    else:
+        u=(1+y*2)*(sin(pi/6)+1)
+        v=x*cos(pi/6)
+    return r*u,r*v
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Per-tick colony statistics gathered into a fixed-size ring buffer and flushed
+to CSV or Parquet in chunks, so memory use does not grow with the run length.
+
+    collector = MetricsCollector("metrics.csv",chunk_size=4096)
+    collector.attach(agents)
+    ...
+    collector.close()
+
+Each row has the tick, food held by and delivered to each nest since the last
+row, food left on the map and carried by agents, agents per AgentState and the
+total mass of each pheromone layer. All of it comes from whole-array reductions
+over the grid and agent arrays. Parquet output needs pyarrow.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+from ant_colony import AgentState, PHEROMONE_LAYERS
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+def metric_columns(num_nests):
+    columns = ["tick"]
+    columns += ["nest_%d_food" % nest_id for nest_id in range(num_nests)]
+    columns += ["nest_%d_delivered" % nest_id for nest_id in range(num_nests)]
+    columns += ["food_remaining","food_carried"]
+    columns += ["agents_" + state.name.lower() for state in AgentState]
+    columns += [layer + "_mass" for layer in PHEROMONE_LAYERS]
+    return columns
+
+class MetricsCollector():
+
+    def __init__(self,path,chunk_size=4096,every=1):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.every = every
+        self.parquet = os.path.splitext(path)[1].lower()==".parquet"
+        if(self.parquet and pyarrow is None):
+            raise ImportError("Parquet metrics output needs pyarrow, use a .csv path instead")
+        self.agents = None
+        self.columns = None
+        self.integer_columns = None
+        self.buffer = None
+        #Rows ever written to the buffer, and how many of them have been flushed
+        self.num_rows = 0
+        self.num_flushed = 0
+        self.parquet_writer = None
+        self.last_nest_food = None
+
+    def attach(self,agents):
+        #Fixes the columns for the current nests, records the current state and then every `every` ticks
+        self.agents = agents
+        num_nests = len(agents.grid.nests)
+        self.columns = metric_columns(num_nests)
+        self.integer_columns = {column:np.int64 for column in self.columns
+                                if column=="tick" or column.startswith("agents_")}
+        self.buffer = np.zeros((self.chunk_size,len(self.columns)))
+        self.last_nest_food = self.nest_food(agents)
+        self.record(agents)
+        agents.add_tick_listener(self)
+
+    def detach(self):
+        if(self.agents is not None):
+            self.agents.remove_tick_listener(self)
+            self.agents = None
+
+    def __call__(self,agents):
+        if(agents.tick%self.every==0):
+            self.record(agents)
+
+    def nest_food(self,agents):
+        return np.fromiter((nest.food for nest in agents.grid.nests),dtype=np.float64,count=len(agents.grid.nests))
+
+    def record(self,agents):
+        grid = agents.grid
+        num_agents = len(agents.agents)
+        alive = agents.agent_alive[:num_agents]
+        nest_food = self.nest_food(agents)
+        num_nests = len(nest_food)
+        row = self.buffer[self.num_rows%self.chunk_size]
+        row[0] = agents.tick
+        row[1:1+num_nests] = nest_food
+        row[1+num_nests:1+2*num_nests] = nest_food-self.last_nest_food
+        offset = 1+2*num_nests
+        row[offset] = np.sum(grid.food,dtype=np.float64)
+        row[offset+1] = np.sum(agents.agent_food[:num_agents][alive],dtype=np.float64)
+        offset += 2
+        row[offset:offset+len(AgentState)] = np.bincount(agents.agent_states[:num_agents][alive],
+                                                         minlength=len(AgentState))[:len(AgentState)]
+        offset += len(AgentState)
+        row[offset:] = np.sum(grid.get_pheromones(),axis=(1,2),dtype=np.float64)
+        self.last_nest_food = nest_food
+        self.num_rows += 1
+        if(self.num_rows-self.num_flushed>=self.chunk_size):
+            self.flush()
+
+    def pending_rows(self):
+        #Rows recorded since the last flush, oldest first
+        return self.ordered_rows(self.num_rows-self.num_flushed)
+
+    def recent(self,num_rows=None):
+        #The last num_rows rows still held in the ring buffer (at most chunk_size) as a DataFrame
+        available = min(self.num_rows,self.chunk_size)
+        num_rows = available if num_rows is None else min(num_rows,available)
+        return self.to_dataframe(self.ordered_rows(num_rows))
+
+    def to_dataframe(self,rows):
+        return pd.DataFrame(rows,columns=self.columns).astype(self.integer_columns)
+
+    def ordered_rows(self,num_rows):
+        end = self.num_rows%self.chunk_size
+        return self.buffer[np.arange(end-num_rows,end)%self.chunk_size]
+
+    def flush(self):
+        num_pending = self.num_rows-self.num_flushed
+        if(num_pending==0):
+            return
+        chunk = self.to_dataframe(self.pending_rows())
+        if(self.parquet):
+            self.write_parquet(chunk)
+        else:
+            chunk.to_csv(self.path,mode="w" if self.num_flushed==0 else "a",header=self.num_flushed==0,index=False)
+        self.num_flushed = self.num_rows
+
+    def write_parquet(self,chunk):
+        table = pyarrow.Table.from_pandas(chunk,preserve_index=False)
+        if(self.parquet_writer is None):
+            self.parquet_writer = pyarrow.parquet.ParquetWriter(self.path,table.schema)
+        self.parquet_writer.write_table(table)
+
+    def close(self):
+        self.detach()
+        if(self.buffer is not None):
+            self.flush()
+        if(self.parquet_writer is not None):
+            self.parquet_writer.close()
+            self.parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs a scenario for many agent_parameters configurations and seeds on a process pool.
+
+The terrain noise is generated once and placed in shared memory, every worker
+builds its grid on top of that read-only array instead of regenerating or
+unpickling it. Results come back as one DataFrame row per run.
+
+    python parameter_sweep.py --seeds 0 1 2 3 --ticks 2000 --output sweep.csv
+"""
+
+import argparse
+import copy
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+import pandas as pd
+from ant_colony import build_scenario, default_agent_parameters
+from terrain import load_noise_field
+
+#Per-worker handle on the shared terrain, set up once by attach_shared_terrain
+_shared_terrain = {}
+
+
+def expand_parameter_grid(parameter_grid):
+    #{"fov_var":[0.4,0.6],"attractor_weights.food":[10,20]} -> list of four override dicts
+    names = list(parameter_grid)
+    return [dict(zip(names,values)) for values in itertools.product(*[parameter_grid[name] for name in names])]
+
+def apply_parameter_overrides(overrides,agent_parameters=None):
+    #Keys are agent_parameters names, nested entries are addressed as "attractor_weights.food"
+    if(agent_parameters is None):
+        agent_parameters = default_agent_parameters()
+    agent_parameters = copy.deepcopy(agent_parameters)
+    for name,value in overrides.items():
+        target = agent_parameters
+        keys = name.split(".")
+        for key in keys[:-1]:
+            target = target[key]
+        if(keys[-1] not in target):
+            raise KeyError("Unknown agent parameter " + name)
+        target[keys[-1]] = value
+    return agent_parameters
+
+def attach_shared_terrain(shm_name,shape,dtype):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    noise_field = np.ndarray(shape,dtype=dtype,buffer=shm.buf)
+    noise_field.flags.writeable = False
+    _shared_terrain["shm"] = shm
+    _shared_terrain["noise_field"] = noise_field
+
+def run_single(scenario,overrides,seed,num_ticks):
+    agent_parameters = apply_parameter_overrides(overrides)
+    start = time.perf_counter()
+    agents = build_scenario(seed=seed,agent_parameters=agent_parameters,batch_mode=True,
+                            noise_field=_shared_terrain["noise_field"],**scenario)
+    for tick in range(num_ticks):
+        agents.iterate_system()
+    row = dict(overrides)
+    row["seed"] = seed
+    nest_food = [nest.food for nest in agents.grid.nests]
+    for nest_index,food in enumerate(nest_food):
+        row["nest_%d_food" % nest_index] = food
+    row["total_food"] = float(np.sum(nest_food))
+    row["wall_time"] = time.perf_counter()-start
+    return row
+
+def run_sweep(scenario,parameter_grid,seeds,num_ticks,terrain_seed=1,max_workers=None,on_result=None):
+    #scenario holds the build_scenario arguments other than seed, e.g. grid_size and num_nests
+    configurations = expand_parameter_grid(parameter_grid)
+    noise_field = load_noise_field(scenario["grid_size"],scenario["perlin_octaves"],terrain_seed,
+                                   scenario.get("terrain_cache_dir"))
+    shm = shared_memory.SharedMemory(create=True,size=noise_field.nbytes)
+    rows = []
+    try:
+        np.ndarray(noise_field.shape,dtype=noise_field.dtype,buffer=shm.buf)[:] = noise_field
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count(),initializer=attach_shared_terrain,
+                                 initargs=(shm.name,noise_field.shape,noise_field.dtype)) as executor:
+            futures = [executor.submit(run_single,scenario,overrides,seed,num_ticks)
+                       for overrides in configurations for seed in seeds]
+            for future in as_completed(futures):
+                row = future.result()
+                rows.append(row)
+                if(on_result is not None):
+                    on_result(row)
+    finally:
+        shm.close()
+        shm.unlink()
+    return pd.DataFrame(rows)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sweep agent parameters over a process pool")
+    parser.add_argument("--seeds",type=int,nargs="+",default=[0,1,2,3])
+    parser.add_argument("--ticks",type=int,default=2000)
+    parser.add_argument("--workers",type=int,default=None)
+    parser.add_argument("--output",default="sweep.csv")
+    args = parser.parse_args(argv)
+    scenario = {"grid_size":[82,39],"perlin_octaves":3,"wall_threshold":0.05,"num_nests":5,"nest_rad":4,
+                "nest_agent_num":5,"num_food":7,"food_rad":3}
+    parameter_grid = {"fov_var":[0.3,0.6,1.2],"attractor_weights.food":[10,20,40],
+                      "attractor_weights.pos_pher":[6,12,24]}
+    results = run_sweep(scenario,parameter_grid,args.seeds,args.ticks,max_workers=args.workers,
+                        on_result=lambda row:print(row))
+    results.to_csv(args.output,index=False)
+    return results
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Optional per-phase timing and work counters for the simulation tick.
+
+An AgentManager with no profiler attached only pays for an `is not None` check
+per phase. Once attached, every tick produces one row with the seconds spent in
+each phase and the counters, handed to on_tick and kept for to_dataframe.
+
+    profiler = TickProfiler(on_tick=print)
+    profiler.attach(agents)
+    ...
+    profiler.to_dataframe().describe()
+
+Phases are the stretches between lap() calls: food pick up and drop off,
+perception raycasts, stat gathering, the weighting and sampling of a direction,
+movement, pheromone deposit and grid decay.
+"""
+
+import time
+import pandas as pd
+
+PHASES = ["food","perception","stats","choice","movement","deposit","decay"]
+COUNTERS = ["agents_stepped","cells_sampled","rays_cut_off","blocked_moves","random_draws"]
+
+
+class TickProfiler():
+
+    def __init__(self,on_tick=None,keep_rows=True):
+        self.on_tick = on_tick
+        self.keep_rows = keep_rows
+        self.rows = []
+        self.agents = None
+        self.phase_seconds = dict.fromkeys(PHASES,0.0)
+        self.counters = dict.fromkeys(COUNTERS,0)
+        self.last_lap = 0.0
+        self.tick_start = 0.0
+
+    def attach(self,agents):
+        self.agents = agents
+        agents.profiler = self
+
+    def detach(self):
+        if(self.agents is not None):
+            self.agents.profiler = None
+            self.agents = None
+
+    def start_tick(self):
+        for phase in self.phase_seconds:
+            self.phase_seconds[phase] = 0.0
+        for counter in self.counters:
+            self.counters[counter] = 0
+        self.tick_start = self.last_lap = time.perf_counter()
+
+    def lap(self,phase):
+        #Charges the time since the previous lap (or the start of the tick) to phase
+        now = time.perf_counter()
+        self.phase_seconds[phase] += now-self.last_lap
+        self.last_lap = now
+
+    def skip(self):
+        #Drops the time since the previous lap, e.g. loop overhead between agents
+        self.last_lap = time.perf_counter()
+
+    def count(self,counter,amount=1):
+        self.counters[counter] += int(amount)
+
+    def end_tick(self,tick):
+        row = {"tick":tick,"total_seconds":time.perf_counter()-self.tick_start}
+        for phase,seconds in self.phase_seconds.items():
+            row[phase+"_seconds"] = seconds
+        row.update(self.counters)
+        if(self.keep_rows):
+            self.rows.append(row)
+        if(self.on_tick is not None):
+            self.on_tick(row)
+        return row
+
+    def to_dataframe(self):
+        return pd.DataFrame(self.rows)
+
+    def summary(self):
+        #Mean seconds per tick for each phase and mean count per tick for each counter
+        frame = self.to_dataframe()
+        if(len(frame)==0):
+            return {}
+        return frame.drop(columns="tick").mean().to_dict()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless raster rendering of the hex grid and video export through OpenCV.
+
+The hexes are rasterised once into a pixel -> cell index map, after that every
+frame is a gather of cell colours through that map. Frames can be written to an
+MP4 with cv2.VideoWriter or as a numbered PNG sequence.
+
+    python raster_render.py runs/seed7/trajectory.traj runs/seed7/run.mp4 --every 10
+"""
+
+import argparse
+import os
+import cv2
+import numpy as np
+from math import cos,pi
+from cell_colours import ColourLUT, WALL_COLOUR
+from hex_geometry import calculate_hexpoints_from_tl, calculate_cartesian_grid_position
+from trajectory import TrajectoryReader, frame_from_agents
+
+BACKGROUND_COLOUR = (0xff,0xff,0xff)
+
+
+class HexRasterizer():
+
+    def __init__(self,grid_size,r=6,outline=True,colour_lut=None):
+        self.grid_size = grid_size
+        self.r = r
+        self.colour_lut = colour_lut if colour_lut is not None else ColourLUT()
+        num_cells = grid_size[0]*grid_size[1]
+        #BGR table with two extra entries, background then outline
+        self.background_index = len(self.colour_lut.rgb)
+        self.outline_index = self.background_index+1
+        self.lut_bgr = np.concatenate([self.colour_lut.rgb,[BACKGROUND_COLOUR,WALL_COLOUR]])[:,::-1].astype(np.uint8)
+        #Same table packed one colour per uint32 so the per pixel gather moves 4 bytes at once
+        self.lut_packed = np.zeros(len(self.lut_bgr),dtype=np.uint32)
+        self.lut_packed.view(np.uint8).reshape(-1,4)[:,:3] = self.lut_bgr
+        self.pixel_cells = self.build_pixel_map(outline)
+        #Gather table indexed by pixel_cells, last two slots hold background and outline
+        self.cell_colours = np.empty(num_cells+2,dtype=np.int32)
+        self.cell_colours[num_cells] = self.background_index
+        self.cell_colours[num_cells+1] = self.outline_index
+
+    def build_pixel_map(self,outline):
+        #Same layout as HexGrid, scaled to r pixels per hex side
+        num_cells = self.grid_size[0]*self.grid_size[1]
+        if(num_cells>=0xfffffe):
+            raise ValueError("Grids above 16 million cells do not fit in the 24 bit cell id map")
+        xs,ys = np.divmod(np.arange(num_cells),self.grid_size[1])
+        hexpoints = []
+        for x,y in zip(xs.tolist(),ys.tolist()):
+            u,v = calculate_cartesian_grid_position(x,y,self.r)
+            hexpoints.append(calculate_hexpoints_from_tl(u+self.r/2,v,self.r))
+        hexpoints = np.array(hexpoints).reshape(num_cells,6,2)
+        width = int(np.ceil(hexpoints[...,0].max()))+1
+        height = int(np.ceil(hexpoints[...,1].max()))+1
+        #Cell ids are written as 24 bit colours since fillPoly only draws 8 bit channels
+        id_image = np.zeros((height,width,3),dtype=np.uint8)
+        cell_codes = np.arange(1,num_cells+1)
+        polygons = np.rint(hexpoints).astype(np.int32)
+        for cell in range(num_cells):
+            code = int(cell_codes[cell])
+            cv2.fillPoly(id_image,[polygons[cell]],(code&0xff,(code>>8)&0xff,(code>>16)&0xff))
+        if(outline):
+            cv2.polylines(id_image,list(polygons),True,(0xff,0xff,0xff),1)
+        codes = (id_image[...,0].astype(np.int64)|(id_image[...,1].astype(np.int64)<<8)
+                 |(id_image[...,2].astype(np.int64)<<16))
+        pixel_cells = codes-1
+        pixel_cells[codes==0] = num_cells
+        pixel_cells[codes==0xffffff] = num_cells+1
+        return pixel_cells.astype(np.int32)
+
+    def render(self,frame,draw_nest_food=True,nest_centres=None):
+        #Returns a BGR uint8 image of a colony_vis frame
+        self.cell_colours[:-2] = self.colour_lut.frame_indices(frame)
+        packed = self.lut_packed[self.cell_colours][self.pixel_cells]
+        image = np.ascontiguousarray(packed.view(np.uint8).reshape(packed.shape+(4,))[...,:3])
+        if(draw_nest_food and nest_centres is not None):
+            for (x,y),nest_food in zip(nest_centres,frame["nest_food"]):
+                u,v = calculate_cartesian_grid_position(x,y,self.r)
+                cv2.putText(image,str(nest_food),(int(u),int(v+self.r*cos(pi/6))),cv2.FONT_HERSHEY_SIMPLEX,
+                            self.r/20,(0,0,0),1,cv2.LINE_AA)
+        return image
+
+class FrameWriter():
+    #Writes frames to an MP4 (or any extension cv2.VideoWriter supports) or, when
+    #path is a directory, as frame_000000.png, frame_000001.png, ...
+
+    def __init__(self,path,frame_size,fps=30,fourcc="mp4v"):
+        self.path = path
+        self.num_frames = 0
+        self.video_writer = None
+        if(os.path.splitext(path)[1]==""):
+            os.makedirs(path,exist_ok=True)
+        else:
+            self.video_writer = cv2.VideoWriter(path,cv2.VideoWriter_fourcc(*fourcc),fps,frame_size)
+            if(not self.video_writer.isOpened()):
+                raise IOError("Unable to open video writer for " + path)
+
+    def write(self,image):
+        if(self.video_writer is not None):
+            self.video_writer.write(image)
+        else:
+            cv2.imwrite(os.path.join(self.path,"frame_%06d.png" % self.num_frames),image)
+        self.num_frames += 1
+
+    def close(self):
+        if(self.video_writer is not None):
+            self.video_writer.release()
+            self.video_writer = None
+
+class VideoRecorder():
+    #Tick listener that renders every `every` ticks of a live AgentManager
+
+    def __init__(self,path,agents,every=1,fps=30,r=6):
+        self.agents = agents
+        self.every = every
+        self.nest_centres = [nest.centre_position for nest in agents.grid.nests]
+        self.rasterizer = HexRasterizer(agents.grid.grid_size,r)
+        height,width = self.rasterizer.pixel_cells.shape
+        self.writer = FrameWriter(path,(width,height),fps)
+        self.write_frame()
+        agents.add_tick_listener(self)
+
+    def __call__(self,agents):
+        if(agents.tick%self.every==0):
+            self.write_frame()
+
+    def write_frame(self):
+        self.writer.write(self.rasterizer.render(frame_from_agents(self.agents),nest_centres=self.nest_centres))
+
+    def close(self):
+        self.agents.remove_tick_listener(self)
+        self.writer.close()
+
+def export_trajectory(reader,path,every=1,fps=30,r=6):
+    rasterizer = HexRasterizer(reader.grid_size,r)
+    height,width = rasterizer.pixel_cells.shape
+    writer = FrameWriter(path,(width,height),fps)
+    for frame in reader.frames(0,every):
+        writer.write(rasterizer.render(frame,nest_centres=reader.nest_centres))
+    writer.close()
+    return writer.num_frames
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render a recorded trajectory to video or PNGs")
+    parser.add_argument("trajectory")
+    parser.add_argument("output",help="video file, or a directory for a PNG sequence")
+    parser.add_argument("--every",type=int,default=1,help="render every Nth record")
+    parser.add_argument("--fps",type=float,default=30)
+    parser.add_argument("--cell-radius",type=int,default=6)
+    args = parser.parse_args(argv)
+    num_frames = export_trajectory(TrajectoryReader(args.trajectory),args.output,args.every,args.fps,args.cell_radius)
+    print("Wrote %d frames to %s" % (num_frames,args.output))
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Runs an ant colony scenario without Tk and writes the final state and a summary.
+
+    python run_headless.py --ticks 100000 --seed 7 --output-dir runs/seed7
+"""
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from ant_colony import AgentState, PERCEPTION_MODES, PHEROMONE_LAYERS, build_scenario
+from field_storage import PHEROMONE_DTYPES
+from metrics import MetricsCollector
+from profiler import TickProfiler
+from tiled import TiledSimulation
+from trajectory import TrajectoryRecorder
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run an ant colony scenario headless")
+    parser.add_argument("--grid-size",type=int,nargs=2,default=[82,39])
+    parser.add_argument("--octaves",type=float,default=3)
+    parser.add_argument("--wall-threshold",type=float,default=0.05)
+    parser.add_argument("--num-nests",type=int,default=5)
+    parser.add_argument("--nest-radius",type=int,default=4)
+    parser.add_argument("--agents-per-nest",type=int,default=5)
+    parser.add_argument("--num-food",type=int,default=7)
+    parser.add_argument("--food-radius",type=int,default=3)
+    parser.add_argument("--food-density",type=float,default=0.5)
+    parser.add_argument("--ticks",type=int,default=10000)
+    parser.add_argument("--seed",type=int,default=None)
+    parser.add_argument("--per-agent",action="store_true",
+                        help="step agents one at a time instead of in batch mode")
+    parser.add_argument("--tiles",type=int,default=None,
+                        help="split the grid into this many bands of rows, each stepped by its own process")
+    parser.add_argument("--perception",default="rays",choices=PERCEPTION_MODES,
+                        help="batch mode perception, fields costs the same whatever the perception range")
+    parser.add_argument("--lazy-decay",action="store_true",
+                        help="decay pheromones when cells are touched instead of sweeping the grid every tick")
+    parser.add_argument("--pheromone-dtype",default="float32",choices=PHEROMONE_DTYPES,
+                        help="storage precision of the pheromone layers, the integer types are fixed point")
+    parser.add_argument("--storage-dir",default=None,
+                        help="keep the grid layers in memory-mapped files in this directory")
+    parser.add_argument("--terrain-cache-dir",default=None)
+    parser.add_argument("--output-dir",default=".")
+    parser.add_argument("--record",action="store_true",
+                        help="write trajectory.traj to the output directory for replay in colony_vis")
+    parser.add_argument("--snapshot-interval",type=int,default=100)
+    parser.add_argument("--metrics",default=None,choices=["csv","parquet"],
+                        help="write per-tick colony statistics to metrics.csv or metrics.parquet")
+    parser.add_argument("--metrics-every",type=int,default=1)
+    parser.add_argument("--profile",action="store_true",
+                        help="time each phase of the tick and write profile.csv to the output directory")
+    return parser.parse_args(argv)
+
+def run_ticks(agents,num_ticks):
+    start = time.perf_counter()
+    for tick in range(num_ticks):
+        agents.iterate_system()
+    return time.perf_counter()-start
+
+def run_tiled_ticks(simulation,num_ticks):
+    #Tick listeners (recorder, metrics) need every tick, otherwise the tiles run unbroken
+    start = time.perf_counter()
+    if(simulation.agents.tick_listeners):
+        for tick in range(num_ticks):
+            simulation.step()
+    else:
+        simulation.step(num_ticks)
+    return time.perf_counter()-start
+
+def summarise(agents):
+    grid = agents.grid
+    alive = agents.agent_alive[:len(agents.agents)]
+    states = agents.agent_states[:len(agents.agents)][alive]
+    summary = {"nest_food":[float(nest.food) for nest in grid.nests],
+               "food_remaining":float(np.sum(grid.food,dtype=np.float64)),
+               "num_agents":int(np.count_nonzero(alive)),
+               "agents_per_state":{state.name:int(np.count_nonzero(states==state.value)) for state in AgentState}}
+    pheromones = grid.get_pheromones()
+    for layer_index,layer in enumerate(PHEROMONE_LAYERS):
+        summary[layer+"_total"] = float(np.sum(pheromones[layer_index],dtype=np.float64))
+    return summary
+
+def save_state(agents,path):
+    grid = agents.grid
+    num_agents = len(agents.agents)
+    np.savez_compressed(path,type=grid.type,nest_id=grid.nest_id,food=grid.food,
+                        pheromones=grid.get_pheromones(),nest_food=np.array([nest.food for nest in grid.nests]),
+                        agent_positions=agents.agent_positions[:num_agents],
+                        agent_directions=agents.agent_directions[:num_agents],
+                        agent_states=agents.agent_states[:num_agents],
+                        agent_food=agents.agent_food[:num_agents],
+                        agent_alive=agents.agent_alive[:num_agents],
+                        agent_caste=agents.agent_caste[:num_agents])
+
+def main(argv=None):
+    args = parse_args(argv)
+    if(args.tiles is not None and args.per_agent):
+        raise SystemExit("--tiles steps agents in batch mode and cannot be combined with --per-agent")
+    if(args.tiles is not None and args.perception!="rays"):
+        raise SystemExit("--tiles only supports --perception rays, field sums cover the whole grid in every tile")
+    if(args.tiles is not None and args.storage_dir is not None):
+        raise SystemExit("--tiles copies the grid into shared memory and cannot be combined with --storage-dir")
+    if(args.tiles is not None and args.profile):
+        raise SystemExit("--profile times the in-process tick and cannot be combined with --tiles")
+    setup_start = time.perf_counter()
+    agents = build_scenario(args.grid_size,args.octaves,args.wall_threshold,args.num_nests,
+                            args.nest_radius,args.agents_per_nest,args.num_food,args.food_radius,
+                            args.food_density,seed=args.seed,batch_mode=not args.per_agent,
+                            terrain_cache_dir=args.terrain_cache_dir,lazy_decay=args.lazy_decay,
+                            perception_mode=args.perception,pheromone_dtype=args.pheromone_dtype,
+                            storage_dir=args.storage_dir)
+    setup_time = time.perf_counter()-setup_start
+    os.makedirs(args.output_dir,exist_ok=True)
+    recorder = None
+    if(args.record):
+        recorder = TrajectoryRecorder(os.path.join(args.output_dir,"trajectory.traj"),args.snapshot_interval)
+        recorder.attach(agents)
+    metrics = None
+    if(args.metrics is not None):
+        metrics = MetricsCollector(os.path.join(args.output_dir,"metrics."+args.metrics),every=args.metrics_every)
+        metrics.attach(agents)
+    profiler = None
+    if(args.profile):
+        profiler = TickProfiler()
+        profiler.attach(agents)
+
+    if(args.tiles is not None):
+        with TiledSimulation(agents,args.tiles) as simulation:
+            run_time = run_tiled_ticks(simulation,args.ticks)
+    else:
+        run_time = run_ticks(agents,args.ticks)
+    if(recorder is not None):
+        recorder.close()
+    if(metrics is not None):
+        metrics.close()
+    if(profiler is not None):
+        profiler.detach()
+        profiler.to_dataframe().to_csv(os.path.join(args.output_dir,"profile.csv"),index=False)
+    ticks_per_second = args.ticks/run_time if run_time>0 else float("inf")
+    print("%d ticks in %.2fs (%.1f ticks/s), setup %.2fs" % (args.ticks,run_time,ticks_per_second,setup_time))
+
+    summary = {"scenario":vars(args),"setup_seconds":setup_time,"run_seconds":run_time,
+               "ticks_per_second":ticks_per_second}
+    summary.update(summarise(agents))
+    if(profiler is not None):
+        summary["profile_means"] = profiler.summary()
+    save_state(agents,os.path.join(args.output_dir,"final_state.npz"))
+    with open(os.path.join(args.output_dir,"summary.json"),"w") as summary_file:
+        json.dump(summary,summary_file,indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+   main()
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+Seedable random streams for a simulation run, built on np.random.Generator.
+
+A SimulationRNG splits its SeedSequence into independent streams for the map
+layout (nest and food placement), the agents (spawn points and starting
+directions) and the agents' direction choices, so the same seed gives the same
+run whatever else uses random numbers in the process. spawn() splits off child
+SimulationRNGs deterministically, one per run of a sweep or per worker.
+
+    rng = SimulationRNG(7)
+    grid = Grid(grid_size,perlin_octaves,wall_threshold,seed=7,rng=rng)
+    runs = rng.spawn(4)
+
+Direction choices are made by inverse-CDF sampling from uniforms handed out of
+a pre-generated block, refilled block_size at a time. Generator.random draws
+one 64 bit output per double, so the uniforms handed out are the same whatever
+the block size.
+"""
+
+import numpy as np
+
+
+def terrain_seed(seed=None):
+    #A positive int for the terrain noise derived from seed, which may be 0 or None (fresh entropy).
+    #PerlinNoise treats a falsy seed as unseeded and a zero seed would give every lattice corner
+    #the same gradient, so seeds are never passed to it as they are.
+    state = np.random.SeedSequence(seed).generate_state(1,np.uint32)[0]
+    return int(state)%(2**31-1)+1
+
+class SimulationRNG():
+
+    def __init__(self,seed=None,block_size=4096):
+        if(isinstance(seed,np.random.SeedSequence)):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        self.block_size = block_size
+        layout_seed,agents_seed,decisions_seed = self.seed_sequence.spawn(3)
+        self.layout = np.random.default_rng(layout_seed)
+        self.agents = np.random.default_rng(agents_seed)
+        self.decisions = np.random.default_rng(decisions_seed)
+        self.block = np.zeros(0)
+        self.block_position = 0
+
+    def spawn(self,num_children):
+        #Independent child streams, the same children for the same seed and spawn order
+        return [SimulationRNG(child_seed,self.block_size) for child_seed in self.seed_sequence.spawn(num_children)]
+
+    def uniforms(self,count):
+        #The next count decision uniforms in [0,1)
+        end = self.block_position+count
+        if(end>len(self.block)):
+            self.block = np.concatenate([self.block[self.block_position:],
+                                         self.decisions.random(max(self.block_size,count))])
+            self.block_position = 0
+            end = count
+        uniforms = self.block[self.block_position:end]
+        self.block_position = end
+        return uniforms
+
+    def uniform(self):
+        #A single decision uniform, for the per agent step
+        if(self.block_position>=len(self.block)):
+            self.block = self.decisions.random(self.block_size)
+            self.block_position = 0
+        uniform = self.block[self.block_position]
+        self.block_position += 1
+        return float(uniform)
+
+    def counter_seed(self):
+        #A 64 bit seed for ant_colony.counter_uniforms derived from this run's seed
+        return int(self.seed_sequence.generate_state(1,np.uint64)[0])
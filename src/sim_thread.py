@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Runs a simulation in a background thread that publishes frames for a viewer.
+
+The thread steps the AgentManager ticks_per_frame ticks at a time, as fast as
+it can, and after each batch publishes an immutable snapshot: the ColourLUT
+index of every cell, the live agents' positions and the nest food. Snapshots go
+into a bounded queue. When the viewer falls behind the oldest snapshot is
+dropped rather than the simulation waiting, and latest_frame() hands the viewer
+only the newest one, so neither side ever stalls the other.
+
+    simulation = SimulationThread(agents,ticks_per_frame=10)
+    simulation.start()
+    frame = simulation.latest_frame()   #None when nothing new was published
+    simulation.stop()
+
+All stepping happens on the simulation thread, including tick listeners, so the
+AgentManager must not be touched from elsewhere while the thread runs.
+"""
+
+import queue
+import threading
+import traceback
+from cell_colours import ColourLUT
+from trajectory import frame_from_agents
+
+
+def snapshot_frame(agents,colour_lut):
+    #A read-only frame holding copies only, safe to hand to another thread
+    frame = frame_from_agents(agents)
+    snapshot = {"tick":frame["tick"],"colours":colour_lut.frame_indices(frame),
+                "agent_positions":frame["agent_positions"][frame["agent_alive"]],
+                "nest_food":tuple(frame["nest_food"])}
+    snapshot["colours"].flags.writeable = False
+    snapshot["agent_positions"].flags.writeable = False
+    return snapshot
+
+class SimulationThread():
+
+    def __init__(self,agents,ticks_per_frame=1,max_frames=2,max_ticks=None,colour_lut=None):
+        self.agents = agents
+        #Read before every frame, so it can be changed while the thread runs
+        self.ticks_per_frame = ticks_per_frame
+        #The thread stops by itself once agents.tick reaches max_ticks
+        self.max_ticks = max_ticks
+        self.colour_lut = ColourLUT() if colour_lut is None else colour_lut
+        self.frames = queue.Queue(maxsize=max_frames)
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.error = None
+        #Frames that were published but never handed out by latest_frame, counted from both threads
+        self.dropped_frames = 0
+        self.dropped_lock = threading.Lock()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run,name="simulation",daemon=True)
+        self.thread.start()
+        return self
+
+    def run(self):
+        try:
+            self.publish(snapshot_frame(self.agents,self.colour_lut))
+            while(not self.stop_event.is_set() and not self.finished_ticks()):
+                for tick in range(max(1,int(self.ticks_per_frame))):
+                    if(self.stop_event.is_set() or self.finished_ticks()):
+                        break
+                    self.agents.iterate_system()
+                self.publish(snapshot_frame(self.agents,self.colour_lut))
+        except Exception:
+            self.error = traceback.format_exc()
+
+    def finished_ticks(self):
+        return self.max_ticks is not None and self.agents.tick>=self.max_ticks
+
+    def publish(self,frame):
+        #Puts frame in the queue, making room by dropping the oldest frame when it is full
+        while(True):
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.count_dropped()
+                except queue.Empty:
+                    pass
+
+    def count_dropped(self):
+        with self.dropped_lock:
+            self.dropped_frames += 1
+
+    def latest_frame(self):
+        #The newest frame published since the last call, or None. Older frames are dropped.
+        frame = None
+        while(True):
+            try:
+                newer = self.frames.get_nowait()
+            except queue.Empty:
+                break
+            if(frame is not None):
+                self.count_dropped()
+            frame = newer
+        if(frame is None and self.error is not None):
+            raise RuntimeError("Simulation thread failed:\n" + self.error)
+        return frame
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stop(self,timeout=None):
+        self.stop_event.set()
+        if(self.thread is not None):
+            self.thread.join(timeout)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+import numpy as np
+import os
+import random
+import tempfile
+
+
+def perlin_noise_field(grid_size,perlin_octaves,seed,out=None,chunks=None):
+    #Evaluates PerlinNoise(octaves=perlin_octaves,seed=seed)([x/grid_size[0],y/grid_size[1]])
+    #for every cell at once. Gradients are drawn exactly as the perlin_noise package draws them,
+    #once per lattice corner instead of once per cell. Rows are independent, so they are written
+    #into out (a new float32 array by default) one (start,stop) range of chunks at a time.
+    if(out is None):
+        out = np.empty((grid_size[0],grid_size[1]),dtype=np.float32)
+    if(chunks is None):
+        chunks = [(0,grid_size[0])]
+    u = np.arange(grid_size[0])/grid_size[0]*perlin_octaves
+    v = np.arange(grid_size[1])/grid_size[1]*perlin_octaves
+    u_floor = np.floor(u).astype(np.int64)
+    v_floor = np.floor(v).astype(np.int64)
+    gradients = lattice_gradients(int(u_floor.max())+2,int(v_floor.max())+2,seed)
+
+    for start,stop in chunks:
+        noise = np.zeros((stop-start,grid_size[1]))
+        for du in (0,1):
+            for dv in (0,1):
+                dist_u = (u[start:stop]-(u_floor[start:stop]+du))[:,None]
+                dist_v = (v-(v_floor+dv))[None,:]
+                corner_gradients = gradients[(u_floor[start:stop]+du)[:,None],(v_floor+dv)[None,:]]
+                weight = fade(1-np.abs(dist_u))*fade(1-np.abs(dist_v))
+                noise += weight*(corner_gradients[...,0]*dist_u+corner_gradients[...,1]*dist_v)
+        out[start:stop] = noise
+    return out
+
+def lattice_gradients(num_u,num_v,seed):
+    gradients = np.empty((num_u,num_v,2))
+    for cu in range(num_u):
+        for cv in range(num_v):
+            corner_random = random.Random(seed*max(1,abs(cu+10*cv+1)))
+            gradients[cu,cv,0] = corner_random.uniform(-1,1)
+            gradients[cu,cv,1] = corner_random.uniform(-1,1)
+    return gradients
+
+def fade(t):
+    return 6*t**5-15*t**4+10*t**3
+
+def terrain_cache_path(cache_dir,grid_size,perlin_octaves,seed):
+    return os.path.join(cache_dir,"perlin_%dx%d_o%s_s%d.npy" % (grid_size[0],grid_size[1],perlin_octaves,seed))
+
+def copy_rows(source,out,chunks):
+    for start,stop in chunks:
+        out[start:stop] = source[start:stop]
+    return out
+
+def load_noise_field(grid_size,perlin_octaves,seed,cache_dir=None,out=None,chunks=None):
+    #Noise fields are cached as .npy files keyed by (grid_size,octaves,seed) and opened memory-mapped,
+    #so without an out array a cached field is paged in as it is read. With out, e.g. a memmap of
+    #the grid's storage_dir, the field is generated or copied into it chunk by chunk.
+    if(cache_dir is None):
+        return perlin_noise_field(grid_size,perlin_octaves,seed,out,chunks)
+    cache_path = terrain_cache_path(cache_dir,grid_size,perlin_octaves,seed)
+    if(not os.path.exists(cache_path)):
+        os.makedirs(cache_dir,exist_ok=True)
+        #Generate into a temporary file first so concurrent runs never read a partial cache entry
+        file_descriptor,temp_path = tempfile.mkstemp(dir=cache_dir,suffix=".npy")
+        os.close(file_descriptor)
+        noise = np.lib.format.open_memmap(temp_path,mode="w+",dtype=np.float32,shape=(grid_size[0],grid_size[1]))
+        perlin_noise_field(grid_size,perlin_octaves,seed,noise,chunks)
+        noise.flush()
+        del noise
+        os.replace(temp_path,cache_path)
+    cached = np.load(cache_path,mmap_mode="r")
+    if(out is None):
+        return cached
+    return copy_rows(cached,out,chunks or [(0,grid_size[0])])
@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled domain decomposition of a batch mode run over worker processes.
+
+The grid is split into bands of rows, one per worker. Every grid array, the
+occupancy counts and the lookup tables live in shared memory, so the halo a
+worker perceives beyond its own rows is simply read from its neighbours' rows.
+A worker only ever writes food, pheromones and pheromone ticks on the cells it
+owns (agents deposit on the cell they start the tick on), plus the occupancy of
+a cell one of its agents moves into. Each tick runs in three barrier separated
+phases:
+
+    1. food pick up and drop off
+    2. perception and choice of direction, moves are posted as claims
+    3. claims are resolved against the neighbouring tiles' claims (lowest agent
+       id wins), agents move, deposit and the owned rows decay. Agents that left
+       the band are posted to an outbox and picked up by the neighbour.
+
+Random draws are hashed from (rng_seed,tick,agent id) by counter_uniforms, so
+the result is the same whatever the number of tiles. rng_seed defaults to one
+derived from the manager's SimulationRNG.
+
+    agents = build_scenario(...,batch_mode=True)
+    with TiledSimulation(agents,num_tiles=8) as simulation:
+        simulation.step(10000)
+"""
+
+import gc
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+import numpy as np
+from ant_colony import AgentManager, Grid, Nest, SHARED_GRID_ARRAYS, counter_uniforms
+
+#Agents move at most two rows a tick (UP and DOWN), with at least this many rows per
+#tile a cell can only be claimed from its own tile and the two next to it
+MIN_TILE_ROWS = 4
+HANDOFF_RECORD = np.dtype([("agent_id","<i8"),("x","<i4"),("y","<i4"),("direction","i1"),
+                           ("state","i1"),("alive","?"),("food","<f4"),("caste","u1")])
+
+
+def tile_row_bounds(num_rows,num_tiles):
+    #Row bounds of num_tiles bands of near equal height, tile i owns rows bounds[i]:bounds[i+1]
+    bounds = np.linspace(0,num_rows,num_tiles+1).round().astype(int)
+    if(np.min(np.diff(bounds))<MIN_TILE_ROWS):
+        raise ValueError("%d rows are too few for %d tiles of at least %d rows" % (num_rows,num_tiles,MIN_TILE_ROWS))
+    return bounds.tolist()
+
+def agent_records(agent_ids,positions,directions,states,alive,food,castes):
+    records = np.empty(len(agent_ids),dtype=HANDOFF_RECORD)
+    records["agent_id"] = agent_ids
+    records["x"] = positions[:,0]
+    records["y"] = positions[:,1]
+    records["direction"] = directions
+    records["state"] = states
+    records["alive"] = alive
+    records["food"] = food
+    records["caste"] = castes
+    return records
+
+class SharedArrays():
+    #Named arrays, each in its own shared memory block, that workers re-open by name
+
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+
+    def share(self,name,array):
+        block = shared_memory.SharedMemory(create=True,size=max(1,array.nbytes))
+        shared = np.ndarray(array.shape,dtype=array.dtype,buffer=block.buf)
+        shared[...] = array
+        self.blocks[name] = block
+        self.arrays[name] = shared
+        return shared
+
+    def specs(self):
+        return {name:(self.blocks[name].name,array.shape,array.dtype) for name,array in self.arrays.items()}
+
+    @classmethod
+    def attach(cls,specs):
+        shared = cls()
+        for name,(block_name,shape,dtype) in specs.items():
+            block = shared_memory.SharedMemory(name=block_name)
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape,dtype=dtype,buffer=block.buf)
+        return shared
+
+    def close(self,unlink=False):
+        self.arrays = {}
+        for block in self.blocks.values():
+            block.close()
+            if(unlink):
+                block.unlink()
+        self.blocks = {}
+
+class TileWorker():
+    #One band of rows, stepped in lockstep with the other tiles through the barrier
+
+    def __init__(self,tile_index,row_bounds,shared,settings,barrier):
+        self.tile_index = tile_index
+        self.rows = (row_bounds[tile_index],row_bounds[tile_index+1])
+        self.neighbor_tiles = [tile for tile in (tile_index-1,tile_index+1) if 0<=tile<len(row_bounds)-1]
+        self.shared = shared
+        self.barrier = barrier
+        self.rng_seed = settings["rng_seed"]
+        arrays = shared.arrays
+        grid = Grid(settings["grid_size"],settings["perlin_octaves"],settings["wall_threshold"],
+                    seed=settings["seed"],noise_field=arrays["noise_field"],lazy_decay=settings["lazy_decay"],
+                    decay_epsilon=settings["decay_epsilon"],shared_arrays=arrays)
+        grid.pos_pher_decay_rate,grid.neg_pher_decay_rate,grid.forage_pher_decay_rate = settings["decay_rates"]
+        for centre in settings["nest_centres"]:
+            grid.register_nest(Nest(centre,[]))
+        self.agents = AgentManager(grid,batch_mode=True,agent_parameters=settings["castes"][0])
+        for agent_parameters in settings["castes"][1:]:
+            self.agents.add_caste(agent_parameters)
+        grid.ray_tables[self.agents.max_perception_range()] = arrays["ray_table"]
+        self.agents.max_capacity = settings["max_capacity"]
+        self.agents.occupancy = arrays["occupancy"]
+        self.set_agents(np.zeros(0,dtype=HANDOFF_RECORD))
+
+    def set_agents(self,records):
+        #Agents are kept in agent_id order, batch_take_food relies on it
+        records = np.sort(records,order="agent_id")
+        agents = self.agents
+        self.agent_ids = records["agent_id"].copy()
+        agents.agent_positions = np.stack([records["x"],records["y"]],axis=1).astype(np.int32)
+        agents.agent_directions = records["direction"].copy()
+        agents.agent_states = records["state"].copy()
+        agents.agent_alive = records["alive"].copy()
+        agents.agent_food = records["food"].copy()
+        agents.agent_caste = records["caste"].copy()
+
+    def get_agents(self):
+        agents = self.agents
+        return agent_records(self.agent_ids,agents.agent_positions,agents.agent_directions,
+                             agents.agent_states,agents.agent_alive,agents.agent_food,agents.agent_caste)
+
+    def run(self,start_tick,decay_tick,num_ticks):
+        self.agents.grid.decay_tick = decay_tick
+        for tick in range(start_tick,start_tick+num_ticks):
+            self.step(tick)
+        return self.get_agents(),[nest.food for nest in self.agents.grid.nests]
+
+    def step(self,tick):
+        agents = self.agents
+        grid = agents.grid
+        arrays = self.shared.arrays
+        alive = np.nonzero(agents.agent_alive)[0]
+        arrays["tile_agent_counts"][self.tile_index] = len(self.agent_ids)
+        step = agents.batch_collect_food(alive)
+        self.barrier.wait()
+        #A tile posts at most one claim and one departure per agent it holds, so the claim and
+        #outbox buffers are laid out tile after tile with room for each tile's agents
+        self.buffer_offsets = np.concatenate([[0],np.cumsum(arrays["tile_agent_counts"])]).tolist()
+
+        agents.batch_choose_directions(step,counter_uniforms(self.rng_seed,tick,self.agent_ids[alive]))
+        movers,target_cells = agents.batch_claims(step)
+        mover_ids = self.agent_ids[alive[movers]]
+        start = self.buffer_offsets[self.tile_index]
+        arrays["claim_ids"][start:start+len(movers)] = mover_ids
+        arrays["claim_cells"][start:start+len(movers)] = target_cells
+        arrays["claim_counts"][self.tile_index] = len(movers)
+        self.barrier.wait()
+
+        won = self.resolve_claims(mover_ids,target_cells)
+        agents.batch_move(step,movers[won],target_cells[won])
+        agents.batch_deposit(step)
+        grid.decay_tick += 1
+        if(not grid.lazy_decay):
+            grid.decay_pheromone_rows(*self.rows)
+        self.post_departures()
+        self.barrier.wait()
+        self.collect_arrivals()
+
+    def resolve_claims(self,mover_ids,target_cells):
+        #True for the claims whose agent has the lowest id of every claim on its cell
+        arrays = self.shared.arrays
+        claim_ids = [mover_ids]
+        claim_cells = [target_cells]
+        for tile in self.neighbor_tiles:
+            start = self.buffer_offsets[tile]
+            stop = start+arrays["claim_counts"][tile]
+            claim_ids.append(arrays["claim_ids"][start:stop])
+            claim_cells.append(arrays["claim_cells"][start:stop])
+        claim_ids = np.concatenate(claim_ids)
+        claim_cells = np.concatenate(claim_cells)
+        order = np.lexsort((claim_ids,claim_cells))
+        winning_cells,first_claims = np.unique(claim_cells[order],return_index=True)
+        winning_ids = claim_ids[order][first_claims]
+        return winning_ids[np.searchsorted(winning_cells,target_cells)]==mover_ids
+
+    def post_departures(self):
+        records = self.get_agents()
+        leaving = (records["x"]<self.rows[0]) | (records["x"]>=self.rows[1])
+        outbox = self.shared.arrays["outbox"]
+        start = self.buffer_offsets[self.tile_index]
+        outbox[start:start+np.count_nonzero(leaving)] = records[leaving]
+        self.shared.arrays["outbox_counts"][self.tile_index] = np.count_nonzero(leaving)
+        if(np.any(leaving)):
+            self.set_agents(records[~leaving])
+
+    def collect_arrivals(self):
+        arrays = self.shared.arrays
+        arrivals = []
+        for tile in self.neighbor_tiles:
+            start = self.buffer_offsets[tile]
+            records = arrays["outbox"][start:start+arrays["outbox_counts"][tile]]
+            arrivals.append(records[(records["x"]>=self.rows[0]) & (records["x"]<self.rows[1])])
+        if(sum(len(records) for records in arrivals)>0):
+            self.set_agents(np.concatenate([self.get_agents()]+arrivals))
+
+def tile_worker(tile_index,row_bounds,specs,settings,connection,barrier):
+    #Process entry point, serves ("agents",records), ("run",tick,decay_tick,num_ticks) and ("stop",)
+    shared = SharedArrays.attach(specs)
+    worker = None
+    error = None
+    try:
+        worker = TileWorker(tile_index,row_bounds,shared,settings,barrier)
+    except Exception:
+        error = traceback.format_exc()
+    while(True):
+        command = connection.recv()
+        if(command[0]=="stop"):
+            break
+        try:
+            if(error is not None):
+                raise RuntimeError(error)
+            if(command[0]=="agents"):
+                worker.set_agents(command[1])
+                connection.send(("ok",))
+            elif(command[0]=="run"):
+                connection.send(("ok",)+worker.run(*command[1:]))
+        except Exception:
+            #Release the other tiles from the barrier before reporting
+            barrier.abort()
+            connection.send(("error",traceback.format_exc()))
+    #The grid views have to go before the shared memory can be closed, Grid holds a reference cycle
+    worker = None
+    gc.collect()
+    shared.close()
+
+class TiledSimulation():
+    #Runs a batch mode AgentManager over num_tiles worker processes. While it is open the
+    #manager's grid and occupancy arrays live in shared memory and are brought up to date,
+    #along with the agent arrays and nest food, after every step().
+
+    def __init__(self,agents,num_tiles,rng_seed=None):
+        grid = agents.grid
+        #The grid is copied into shared memory, memory-mapped layers would silently end up in RAM
+        if(grid.storage_dir is not None):
+            raise ValueError("TiledSimulation cannot run a grid with a storage_dir")
+        #Field perception sums over the whole grid, every tile would repeat the full pass
+        if(agents.perception_mode!="rays"):
+            raise ValueError("TiledSimulation only supports the rays perception mode")
+        self.agents = agents
+        self.num_tiles = num_tiles
+        num_agents = len(agents.agents)
+        self.row_bounds = tile_row_bounds(grid.grid_size[0],num_tiles)
+        perception_range = agents.max_perception_range()
+
+        self.shared = SharedArrays()
+        for name in SHARED_GRID_ARRAYS:
+            if(getattr(grid,name) is not None):
+                setattr(grid,name,self.shared.share(name,getattr(grid,name)))
+        grid.positive_pher,grid.negative_pher,grid.forage_pher = grid.pheromones
+        grid.noise_field = self.shared.share("noise_field",grid.noise_field)
+        grid.ray_tables = {perception_range:self.shared.share("ray_table",grid.get_ray_table(perception_range))}
+        agents.occupancy = self.shared.share("occupancy",agents.occupancy)
+        #Claim and outbox buffers hold every agent once, split between the tiles every tick
+        #by tile_agent_counts (see TileWorker.step)
+        capacity = max(1,num_agents)
+        self.shared.share("tile_agent_counts",np.zeros(num_tiles,dtype=np.int64))
+        self.shared.share("claim_ids",np.zeros(capacity,dtype=np.int64))
+        self.shared.share("claim_cells",np.zeros(capacity,dtype=np.int64))
+        self.shared.share("claim_counts",np.zeros(num_tiles,dtype=np.int64))
+        self.shared.share("outbox",np.zeros(capacity,dtype=HANDOFF_RECORD))
+        self.shared.share("outbox_counts",np.zeros(num_tiles,dtype=np.int64))
+
+        settings = {"grid_size":list(grid.grid_size),"perlin_octaves":grid.perlin_noise.octaves,
+                    "wall_threshold":0,"seed":grid.seed,"lazy_decay":grid.lazy_decay,
+                    "decay_epsilon":grid.decay_epsilon,
+                    "decay_rates":(grid.pos_pher_decay_rate,grid.neg_pher_decay_rate,grid.forage_pher_decay_rate),
+                    "nest_centres":[nest.centre_position for nest in grid.nests],
+                    "castes":agents.castes,"max_capacity":agents.max_capacity,
+                    "rng_seed":agents.rng.counter_seed() if rng_seed is None else rng_seed}
+        self.base_nest_food = [nest.food for nest in grid.nests]
+        records = agent_records(np.arange(num_agents),agents.agent_positions[:num_agents],
+                                agents.agent_directions[:num_agents],agents.agent_states[:num_agents],
+                                agents.agent_alive[:num_agents],agents.agent_food[:num_agents],
+                                agents.agent_caste[:num_agents])
+        context = multiprocessing.get_context()
+        barrier = context.Barrier(num_tiles)
+        self.connections = []
+        self.processes = []
+        for tile_index in range(num_tiles):
+            connection,worker_connection = context.Pipe()
+            process = context.Process(target=tile_worker,daemon=True,
+                                      args=(tile_index,self.row_bounds,self.shared.specs(),settings,
+                                            worker_connection,barrier))
+            process.start()
+            tile_rows = (records["x"]>=self.row_bounds[tile_index]) & (records["x"]<self.row_bounds[tile_index+1])
+            connection.send(("agents",records[tile_rows]))
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.receive_all()
+
+    def receive_all(self):
+        replies = [connection.recv() for connection in self.connections]
+        errors = [reply[1] for reply in replies if reply[0]=="error"]
+        if(errors):
+            raise RuntimeError("Tile worker failed:\n" + errors[0])
+        return replies
+
+    def step(self,num_ticks=1):
+        #Advances every tile num_ticks ticks, then syncs the AgentManager and calls its tick listeners once
+        agents = self.agents
+        grid = agents.grid
+        for connection in self.connections:
+            connection.send(("run",agents.tick,grid.decay_tick,num_ticks))
+        nest_food = np.array(self.base_nest_food,dtype=np.float64)
+        for reply in self.receive_all():
+            records,tile_nest_food = reply[1],reply[2]
+            agent_ids = records["agent_id"]
+            agents.agent_positions[agent_ids,0] = records["x"]
+            agents.agent_positions[agent_ids,1] = records["y"]
+            agents.agent_directions[agent_ids] = records["direction"]
+            agents.agent_states[agent_ids] = records["state"]
+            agents.agent_alive[agent_ids] = records["alive"]
+            agents.agent_food[agent_ids] = records["food"]
+            nest_food += tile_nest_food
+        for nest,food in zip(grid.nests,nest_food.tolist()):
+            nest.food = food
+        agents.tick += num_ticks
+        grid.decay_tick += num_ticks
+        for listener in agents.tick_listeners:
+            listener(agents)
+
+    def close(self):
+        #Stops the workers and moves the grid back into private memory
+        if(self.shared is None):
+            return
+        for connection,process in zip(self.connections,self.processes):
+            if(process.is_alive()):
+                connection.send(("stop",))
+            process.join()
+        grid = self.agents.grid
+        for name in SHARED_GRID_ARRAYS:
+            if(getattr(grid,name) is not None):
+                setattr(grid,name,np.array(getattr(grid,name)))
+        grid.positive_pher,grid.negative_pher,grid.forage_pher = grid.pheromones
+        grid.noise_field = np.array(grid.noise_field)
+        grid.ray_tables = {}
+        self.agents.occupancy = np.array(self.agents.occupancy)
+        self.shared.close(unlink=True)
+        self.shared = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
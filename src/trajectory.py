@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only recording of simulation runs and memory-mapped read back.
+
+A recording is two files. The trajectory file starts with a JSON header and
+the static layers (cell types and nest ids), followed by one record per tick
+holding agent positions, directions, states, food loads, alive flags and nest
+food. Every snapshot_interval records the food and pheromone layers are stored
+in full. The records in between hold the per layer decay factor since the last
+record, which the reader applies to every cell, and then only the cells whose
+food changed or whose pheromones ended up on a different ColourLUT display
+level than the decayed values, i.e. mostly the cells agents deposited on or
+took food from. Replayed pheromones between snapshots are therefore exact to
+within their display level, and every replayed frame draws exactly as the live
+one did. The .idx
+file next to it has one (tick, offset, snapshot record) row per record so a
+reader can jump straight to any tick.
+
+    recorder = TrajectoryRecorder("run.traj",snapshot_interval=100)
+    recorder.attach(agents)
+    ...
+    recorder.close()
+    reader = TrajectoryReader("run.traj")
+    frame = reader.frame(reader.num_records-1)
+
+Frames, from a reader or from frame_from_agents on a live AgentManager, are
+dicts with tick, type, layers, agent_positions, agent_alive and nest_food.
+"""
+
+import json
+import numpy as np
+from ant_colony import PHEROMONE_LAYERS
+from cell_colours import ColourLUT
+
+MAGIC = b"ANTTRAJ2"
+RECORD_HEADER = np.dtype([("tick","<i8"),("num_agents","<i8"),("num_nests","<i8"),("num_cells","<i8")])
+INDEX_ENTRY = np.dtype([("tick","<i8"),("offset","<i8"),("snapshot_record","<i8")])
+#Dynamic layers in the order they are stored, food first then PHEROMONE_LAYERS
+LAYER_NAMES = ["food"]+PHEROMONE_LAYERS
+
+
+def padding_for(num_bytes):
+    return (-num_bytes)%8
+
+class TrajectoryRecorder():
+
+    def __init__(self,path,snapshot_interval=100,colour_lut=None):
+        self.path = path
+        self.snapshot_interval = snapshot_interval
+        #Deltas compare pheromones quantised to this LUT's levels
+        self.colour_lut = ColourLUT() if colour_lut is None else colour_lut
+        self.trajectory_file = None
+        self.index_file = None
+        self.num_records = 0
+        self.last_snapshot_record = 0
+        #Flat layers as a reader replaying the records so far sees them, and the decay tick they are at
+        self.last_layers = None
+        self.last_decay_tick = 0
+        self.agents = None
+
+    def attach(self,agents):
+        #Writes the header and the current state, then records after every tick
+        self.open(agents.grid)
+        self.agents = agents
+        self.record(agents)
+        agents.add_tick_listener(self)
+
+    def detach(self):
+        if(self.agents is not None):
+            self.agents.remove_tick_listener(self)
+            self.agents = None
+
+    def __call__(self,agents):
+        self.record(agents)
+
+    def open(self,grid):
+        self.trajectory_file = open(self.path,"wb")
+        self.index_file = open(self.path+".idx","wb")
+        header = {"grid_size":[int(size) for size in grid.grid_size],"layers":LAYER_NAMES,
+                  "snapshot_interval":self.snapshot_interval,"pheromone_levels":self.colour_lut.levels,
+                  "nest_centres":[[int(v) for v in nest.centre_position] for nest in grid.nests]}
+        header_bytes = json.dumps(header).encode("utf-8")
+        header_bytes += b" "*padding_for(len(MAGIC)+8+len(header_bytes))
+        self.trajectory_file.write(MAGIC)
+        self.trajectory_file.write(np.int64(len(header_bytes)).tobytes())
+        self.trajectory_file.write(header_bytes)
+        self.write_array(grid.type)
+        self.write_array(grid.nest_id)
+
+    def write_array(self,array):
+        array = np.ascontiguousarray(array)
+        self.trajectory_file.write(array.data)
+        self.trajectory_file.write(b"\0"*padding_for(array.nbytes))
+
+    def record(self,agents):
+        grid = agents.grid
+        num_agents = len(agents.agents)
+        food = grid.food.reshape(-1)
+        pheromones = grid.get_pheromones().reshape(len(PHEROMONE_LAYERS),-1)
+        is_snapshot = self.last_layers is None or self.num_records%self.snapshot_interval==0
+        if(is_snapshot):
+            self.last_snapshot_record = self.num_records
+            self.last_layers = np.concatenate([food[None],pheromones])
+        else:
+            #The reader decays every cell by decay, of the cells that then differ only those
+            #drawn at another level are written. With eager float32 storage the decay matches
+            #bit for bit, so only cells agents touched are compared.
+            decay = grid.get_pheromone_decay_factors().reshape(-1,1)**(grid.decay_tick-self.last_decay_tick)
+            self.last_layers[1:] *= decay
+            cells = np.nonzero((food!=self.last_layers[0]) | np.any(pheromones!=self.last_layers[1:],axis=0))[0]
+            changed = ((food[cells]!=self.last_layers[0,cells]) |
+                       np.any(self.colour_lut.quantize(pheromones[:,cells])!=self.colour_lut.quantize(self.last_layers[1:,cells]),axis=0))
+            changed_cells = cells[changed].astype(np.int32)
+            changed_values = np.concatenate([food[None,changed_cells],pheromones[:,changed_cells]])
+            self.last_layers[:,changed_cells] = changed_values
+        self.last_decay_tick = grid.decay_tick
+
+        index_entry = np.array([(agents.tick,self.trajectory_file.tell(),self.last_snapshot_record)],dtype=INDEX_ENTRY)
+        record_header = np.array([(agents.tick,num_agents,len(grid.nests),
+                                   -1 if is_snapshot else len(changed_cells))],dtype=RECORD_HEADER)
+        self.write_array(record_header)
+        self.write_array(agents.agent_positions[:num_agents])
+        self.write_array(agents.agent_directions[:num_agents])
+        self.write_array(agents.agent_states[:num_agents])
+        self.write_array(agents.agent_food[:num_agents])
+        self.write_array(agents.agent_alive[:num_agents])
+        self.write_array(np.array([nest.food for nest in grid.nests],dtype=np.float64))
+        if(is_snapshot):
+            self.write_array(self.last_layers)
+        else:
+            self.write_array(decay.reshape(-1))
+            self.write_array(changed_cells)
+            self.write_array(np.ascontiguousarray(changed_values.T))
+        self.index_file.write(index_entry.data)
+        self.num_records += 1
+
+    def flush(self):
+        self.trajectory_file.flush()
+        self.index_file.flush()
+
+    def close(self):
+        self.detach()
+        if(self.trajectory_file is not None):
+            self.trajectory_file.close()
+            self.index_file.close()
+            self.trajectory_file = None
+            self.index_file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc_info):
+        self.close()
+
+class TrajectoryReader():
+    #Memory maps a recording, only the records that are accessed get paged in
+
+    def __init__(self,path):
+        self.data = np.memmap(path,dtype=np.uint8,mode="r")
+        if(bytes(self.data[:len(MAGIC)])!=MAGIC):
+            raise ValueError(path + " is not a trajectory recording")
+        header_length = int(self.data[len(MAGIC):len(MAGIC)+8].view("<i8")[0])
+        offset = len(MAGIC)+8
+        self.header = json.loads(bytes(self.data[offset:offset+header_length]).decode("utf-8"))
+        offset += header_length
+        self.grid_size = tuple(self.header["grid_size"])
+        self.num_cells = self.grid_size[0]*self.grid_size[1]
+        self.nest_centres = self.header["nest_centres"]
+        self.type,offset = self.read_array(offset,np.uint8,self.grid_size)
+        self.nest_id,offset = self.read_array(offset,np.int16,self.grid_size)
+        index = np.fromfile(path+".idx",dtype=np.uint8)
+        self.index = index[:len(index)-len(index)%INDEX_ENTRY.itemsize].view(INDEX_ENTRY)
+        self.num_records = len(self.index)
+        self.ticks = self.index["tick"]
+
+    def read_array(self,offset,dtype,shape):
+        dtype = np.dtype(dtype)
+        num_bytes = int(np.prod(shape))*dtype.itemsize
+        array = self.data[offset:offset+num_bytes].view(dtype).reshape(shape)
+        return array,offset+num_bytes+padding_for(num_bytes)
+
+    def record_for_tick(self,tick):
+        #Index of the last record at or before tick
+        return max(0,int(np.searchsorted(self.ticks,tick,side="right"))-1)
+
+    def read_record(self,record_index):
+        offset = int(self.index["offset"][record_index])
+        record_header,offset = self.read_array(offset,RECORD_HEADER,1)
+        num_agents = int(record_header["num_agents"][0])
+        record = {"tick":int(record_header["tick"][0])}
+        record["agent_positions"],offset = self.read_array(offset,np.int32,(num_agents,2))
+        record["agent_directions"],offset = self.read_array(offset,np.int8,num_agents)
+        record["agent_states"],offset = self.read_array(offset,np.int8,num_agents)
+        record["agent_food"],offset = self.read_array(offset,np.float32,num_agents)
+        record["agent_alive"],offset = self.read_array(offset,np.bool_,num_agents)
+        record["nest_food"],offset = self.read_array(offset,np.float64,int(record_header["num_nests"][0]))
+        num_cells = int(record_header["num_cells"][0])
+        if(num_cells<0):
+            record["layers"],offset = self.read_array(offset,np.float32,(len(LAYER_NAMES),self.num_cells))
+        else:
+            record["decay"],offset = self.read_array(offset,np.float32,len(PHEROMONE_LAYERS))
+            record["changed_cells"],offset = self.read_array(offset,np.int32,num_cells)
+            record["changed_values"],offset = self.read_array(offset,np.float32,(num_cells,len(LAYER_NAMES)))
+        return record
+
+    def layers(self,record_index):
+        #Food and pheromone layers, shape (len(LAYER_NAMES),)+grid_size, rebuilt from the
+        #nearest snapshot and the deltas after it
+        snapshot_record = int(self.index["snapshot_record"][record_index])
+        layers = np.array(self.read_record(snapshot_record)["layers"])
+        self.apply_deltas(layers,snapshot_record+1,record_index+1)
+        return layers.reshape((len(LAYER_NAMES),)+self.grid_size)
+
+    def apply_deltas(self,layers,start,stop):
+        #Applies the delta records start:stop in order to flat layers, in place
+        for delta_record in range(start,stop):
+            record = self.read_record(delta_record)
+            layers[1:] *= record["decay"][:,None]
+            layers[:,record["changed_cells"]] = record["changed_values"].T
+
+    def frame(self,record_index,layers=None):
+        record = self.read_record(record_index)
+        record.pop("decay",None)
+        record.pop("changed_cells",None)
+        record.pop("changed_values",None)
+        record["layers"] = self.layers(record_index) if layers is None else layers
+        record["type"] = self.type
+        return record
+
+    def frames(self,start=0,every=1,stop=None):
+        #Frames start,start+every,... before stop, for playback and export. The layers are
+        #carried from frame to frame so each delta record is applied once, and rebuilt from
+        #a snapshot only when one lies between two frames.
+        stop = self.num_records if stop is None else min(stop,self.num_records)
+        layers = None
+        position = None
+        for record_index in range(start,stop,every):
+            layers = self.advance_layers(layers,position,record_index)
+            position = record_index
+            yield self.frame(record_index,layers.reshape((len(LAYER_NAMES),)+self.grid_size).copy())
+
+    def advance_layers(self,layers,position,record_index):
+        #Flat layers as of record position brought forward to record_index, updated in place
+        #unless they are None or a snapshot after position makes it quicker to start from there
+        snapshot_record = int(self.index["snapshot_record"][record_index])
+        if(layers is None or snapshot_record>position):
+            layers = np.array(self.read_record(snapshot_record)["layers"])
+            position = snapshot_record
+        self.apply_deltas(layers,position+1,record_index+1)
+        return layers
+
+def frame_from_agents(agents):
+    grid = agents.grid
+    num_agents = len(agents.agents)
+    return {"tick":agents.tick,"type":grid.type,
+            "layers":np.concatenate([grid.food[None],grid.get_pheromones()]),
+            "agent_positions":agents.agent_positions[:num_agents],
+            "agent_alive":agents.agent_alive[:num_agents],
+            "nest_food":[nest.food for nest in grid.nests]}
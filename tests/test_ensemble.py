@@ -0,0 +1,48 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),"..","src"))
+
+from ant_colony import build_scenario, counter_uniforms
+from ensemble import Ensemble
+from sim_rng import SimulationRNG
+
+NUM_REPLICAS = 4
+GRID_SIZE = [41,39]
+SEED = 3
+
+
+def run_standalone(replica,num_ticks,**scenario_options):
+    #Replica replica of the ensemble run on its own, stepped through the batch phases with the
+    #uniforms hashed from its counter seed as the ensemble draws them
+    rng = SimulationRNG(SEED).spawn(NUM_REPLICAS)[replica]
+    counter_seed = rng.counter_seed()
+    agents = build_scenario(GRID_SIZE,3,0.05,3,4,5,5,3,0.5,seed=SEED,batch_mode=True,rng=rng,**scenario_options)
+    for tick in range(num_ticks):
+        alive = np.nonzero(agents.agent_alive[:len(agents.agents)])[0]
+        step = agents.batch_collect_food(alive)
+        agents.batch_choose_directions(step,counter_uniforms(counter_seed,agents.tick,alive))
+        movers,claims = agents.batch_claims(step)
+        claims,first_claims = np.unique(claims,return_index=True)
+        agents.batch_move(step,movers[first_claims],claims)
+        agents.batch_deposit(step)
+        agents.grid.iterate_grid()
+        agents.tick += 1
+    return agents
+
+@pytest.mark.parametrize("scenario_options",[{},{"lazy_decay":True},{"perception_mode":"fields"}])
+def test_ensemble_replicas_match_standalone_runs(scenario_options):
+    ensemble = Ensemble(NUM_REPLICAS,GRID_SIZE,3,0.05,3,4,5,5,3,seed=SEED,**scenario_options)
+    ensemble.step(100)
+    stacked = ensemble.agents
+    pheromones = ensemble.grid.get_pheromones()
+    for replica in range(NUM_REPLICAS):
+        standalone = run_standalone(replica,100,**scenario_options)
+        assert list(ensemble.nest_food()[replica])==[nest.food for nest in standalone.grid.nests]
+        assert np.array_equal(ensemble.replica_layer(ensemble.grid.food)[replica],standalone.grid.food)
+        assert np.array_equal(pheromones[:,ensemble.replica_rows(replica)],standalone.grid.get_pheromones())
+        positions = stacked.agent_positions[:stacked.num_agents][stacked.agent_replica==replica].copy()
+        positions[:,0] -= replica*GRID_SIZE[0]
+        assert np.array_equal(positions,standalone.agent_positions[:len(standalone.agents)])
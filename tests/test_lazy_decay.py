@@ -0,0 +1,31 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),"..","src"))
+
+from ant_colony import build_scenario
+from trajectory import TrajectoryRecorder
+
+
+def run_scenario(num_ticks,recording_path=None):
+    agents = build_scenario([82,39],3,0.05,5,4,30,7,3,0.5,seed=4,batch_mode=True,
+                            lazy_decay=True,pheromone_dtype="uint8")
+    recorder = None
+    if(recording_path is not None):
+        recorder = TrajectoryRecorder(recording_path,snapshot_interval=10)
+        recorder.attach(agents)
+    for tick in range(num_ticks):
+        agents.iterate_system()
+    if(recorder is not None):
+        recorder.close()
+    return agents
+
+def test_recorder_does_not_change_fixed_point_lazy_run(tmp_path):
+    plain = run_scenario(300)
+    recorded = run_scenario(300,str(tmp_path/"run.traj"))
+    assert [nest.food for nest in plain.grid.nests]==[nest.food for nest in recorded.grid.nests]
+    assert np.array_equal(plain.agent_positions,recorded.agent_positions)
+    assert np.array_equal(plain.grid.food,recorded.grid.food)
+    assert np.array_equal(plain.grid.pheromones,recorded.grid.pheromones)
+    assert np.array_equal(plain.grid.pheromone_ticks,recorded.grid.pheromone_ticks)
@@ -0,0 +1,27 @@
+import os
+import sys
+import numpy as np
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),"..","src"))
+
+from ant_colony import build_scenario, default_agent_parameters
+
+
+def test_field_perception_matches_ray_walk():
+    agents = build_scenario([82,39],3,0.05,5,4,30,7,3,0.5,seed=4,batch_mode=True)
+    #A second caste that sees further with another falloff, given to every third agent
+    scout_parameters = default_agent_parameters()
+    scout_parameters["perception_range"] = 10
+    scout_parameters["perception_falloff"] = 0.3
+    scout = agents.add_caste(scout_parameters)
+    agents.agent_caste[:len(agents.agents):3] = scout
+    for tick in range(40):
+        agents.iterate_system()
+
+    step = agents.batch_collect_food(np.nonzero(agents.agent_alive[:len(agents.agents)])[0])
+    candidate_dirs = (step.directions.astype(np.int64)[:,None]+np.arange(-3,3))%6
+    caste_params = agents.caste_parameter_tables()
+    ray_weights,ray_neighbors = agents.batch_ray_perception(step,candidate_dirs,caste_params)
+    field_weights,field_neighbors = agents.batch_field_perception(step,candidate_dirs,caste_params)
+    assert np.array_equal(ray_neighbors,field_neighbors)
+    assert np.allclose(ray_weights,field_weights,rtol=0,atol=1e-9)
@@ -0,0 +1,32 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),"..","src"))
+
+from ant_colony import build_scenario
+from tiled import TiledSimulation
+
+
+def run_tiled(num_tiles,num_ticks,**scenario_options):
+    agents = build_scenario([82,39],3,0.05,5,4,10,7,3,0.5,seed=2,batch_mode=True,**scenario_options)
+    with TiledSimulation(agents,num_tiles) as simulation:
+        simulation.step(num_ticks)
+    return agents
+
+@pytest.mark.parametrize("scenario_options",[{},{"lazy_decay":True},{"pheromone_dtype":"uint8"},
+                                             {"lazy_decay":True,"pheromone_dtype":"uint16"}])
+def test_tiled_run_does_not_depend_on_number_of_tiles(scenario_options):
+    reference = run_tiled(1,60,**scenario_options)
+    num_agents = len(reference.agents)
+    for num_tiles in (2,3,4):
+        tiled = run_tiled(num_tiles,60,**scenario_options)
+        assert len(tiled.agents)==num_agents
+        for name in ("agent_positions","agent_directions","agent_states","agent_food","agent_alive"):
+            assert np.array_equal(getattr(tiled,name)[:num_agents],getattr(reference,name)[:num_agents])
+        assert [nest.food for nest in tiled.grid.nests]==[nest.food for nest in reference.grid.nests]
+        assert np.array_equal(tiled.grid.food,reference.grid.food)
+        assert np.array_equal(tiled.grid.pheromones,reference.grid.pheromones)
+        if(scenario_options.get("lazy_decay")):
+            assert np.array_equal(tiled.grid.pheromone_ticks,reference.grid.pheromone_ticks)